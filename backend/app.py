@@ -1,16 +1,39 @@
 import os
 import json
+import math
+import base64
 import uuid
 import re
-import tempfile
+import time
+import hashlib
+import fnmatch
+import sqlite3
+import queue
+import threading
+import weakref
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from datetime import datetime, date
 from decimal import Decimal
 
 import snowflake.connector
 from snowflake.snowpark import Session
+from snowflake.snowpark.version import VERSION as SNOWPARK_VERSION
 from cryptography.hazmat.primitives import serialization
 
-from flask import Flask, jsonify, request
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+except ImportError:  # chart data falls back to row fetches
+    pa = None
+
+try:
+    import orjson
+except ImportError:  # encode_json falls back to the json module
+    orjson = None
+
+from flask import Flask, Response, jsonify, request
 from flask_cors import CORS
 
 # =========================================================
@@ -18,7 +41,7 @@ from flask_cors import CORS
 # =========================================================
 
 app = Flask(__name__)
-CORS(app)
+CORS(app, expose_headers=["X-Next-Cursor"])
 
 print("\n🚀 Snowflake Cortex Data Intelligence API STARTING...\n")
 
@@ -44,16 +67,84 @@ def sanitize_for_json(obj):
         return float(obj)
     if isinstance(obj, (datetime, date)):
         return obj.isoformat()
+    if isinstance(obj, float) and (obj != obj or obj in (float("inf"), float("-inf"))):
+        return None
     if isinstance(obj, dict):
         return {k: sanitize_for_json(v) for k, v in obj.items()}
-    if isinstance(obj, list):
+    if isinstance(obj, (list, tuple)):
         return [sanitize_for_json(v) for v in obj]
+    if hasattr(obj, "item"):  # numpy scalar
+        return sanitize_for_json(obj.item())
     return obj
 
-def repair_chart_sql(chart, metadata):
+def json_default(obj):
+    """Encoder hook for the types Snowflake rows and pandas hand back"""
+    if isinstance(obj, Decimal):
+        return float(obj)
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    if hasattr(obj, "item"):  # numpy scalar
+        return obj.item()
+    if hasattr(obj, "tolist"):  # numpy array
+        return obj.tolist()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+def encode_json(obj):
+    """
+    Serializes obj to UTF-8 JSON bytes in one pass, with NaN and
+    infinity written as null. Uses orjson when it is installed.
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(
+                obj, default=json_default,
+                option=orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+            )
+        except orjson.JSONEncodeError:
+            # e.g. NUMBER(38,0) values beyond 64 bits; the json module handles them
+            pass
+    try:
+        return json.dumps(obj, default=json_default, allow_nan=False).encode("utf-8")
+    except ValueError:
+        # Only reports that actually contain NaN pay for the copy
+        return json.dumps(sanitize_for_json(obj), default=json_default).encode("utf-8")
+
+def success_response(payload, status=200):
+    """Returns {"status": "success", "data": ...} around already encoded JSON bytes"""
+    return Response(
+        b'{"status": "success", "data": ' + payload + b"}",
+        status=status,
+        mimetype="application/json"
+    )
+
+def run_concurrently(fn, items, max_workers):
+    """Applies fn to each item on a thread pool; results keep the input order"""
+    if len(items) <= 1 or max_workers <= 1:
+        return [fn(item) for item in items]
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as pool:
+        return list(pool.map(fn, items))
+
+# Pipeline stages and agents share one Snowpark session across threads,
+# which is only safe from SNOWPARK_THREAD_SAFE_VERSION on
+SNOWPARK_THREAD_SAFE_VERSION = (1, 24)
+
+def session_workers(max_workers):
+    """max_workers for threads sharing a session; 1 on older Snowpark releases"""
+    if tuple(SNOWPARK_VERSION[:2]) < SNOWPARK_THREAD_SAFE_VERSION:
+        return 1
+    return max_workers
+
+if tuple(SNOWPARK_VERSION[:2]) < SNOWPARK_THREAD_SAFE_VERSION:
+    print(f"⚠️  snowflake-snowpark-python {'.'.join(map(str, SNOWPARK_VERSION))} sessions are not "
+          f"thread-safe; upgrade to >= {'.'.join(map(str, SNOWPARK_THREAD_SAFE_VERSION))} for concurrent "
+          f"stages and queries. Running session work serially.")
+
+def repair_chart_sql(chart, metadata, column_stats=None):
     """
     Dynamically repairs chart SQL using schema metadata.
     NO static SQL. NO hardcoded tables.
+    With column statistics, picks a low-cardinality dimension and a
+    well-populated metric instead of the first matching names.
     """
 
     table = chart.get("table")
@@ -64,6 +155,21 @@ def repair_chart_sql(chart, metadata):
 
     cols = metadata[table]
 
+    stats = (column_stats or {}).get(table)
+    if stats:
+        dim, dim_expr = choose_dimension(cols, stats)
+        metric = choose_metric(cols, stats)
+        if not dim or not metric:
+            return None
+        return {
+            "name": chart.get("name", f"{table} Chart"),
+            "description": chart.get("description", f"Auto-generated chart for {table}"),
+            "chart_type": chart.get("chart_type", "bar"),
+            "sql": stats_chart_sql(table, dim, dim_expr, metric),
+            "x_axis": dim,
+            "y_axis": "VALUE"
+        }
+
     # pick safe dimensions
     dim_candidates = [
         c["column"] for c in cols
@@ -96,40 +202,105 @@ def repair_chart_sql(chart, metadata):
         "y_axis": "VALUE"
     }
 
-def load_private_key_bytes(path, passphrase=None):
-    with open(path, "rb") as f:
-        key = serialization.load_pem_private_key(
-            f.read(),
-            password=passphrase.encode() if passphrase else None
-        )
+def decode_private_key(pem_bytes, passphrase=None):
+    key = serialization.load_pem_private_key(
+        pem_bytes,
+        password=passphrase.encode() if passphrase else None
+    )
     return key.private_bytes(
         encoding=serialization.Encoding.DER,
         format=serialization.PrivateFormat.PKCS8,
         encryption_algorithm=serialization.NoEncryption()
     )
 
-def get_snowflake_session():
-    conn = snowflake.connector.connect(
-        user=os.getenv("SNOWFLAKE_USER"),
-        account=os.getenv("SNOWFLAKE_ACCOUNT"),
-        private_key=load_private_key_bytes(
-            os.getenv("PRIVATE_KEY_PATH"),
-            os.getenv("PRIVATE_KEY_PASSPHRASE")
-        ),
-        warehouse=os.getenv("SNOWFLAKE_WAREHOUSE"),
-        database=os.getenv("SNOWFLAKE_DATABASE"),
-        schema=os.getenv("SNOWFLAKE_SCHEMA"),
-        role=os.getenv("SNOWFLAKE_ROLE")
-    )
-    return Session.builder.configs({"connection": conn}).create()
+def key_fingerprint(pem_bytes, passphrase=None):
+    """Fingerprint of the key material, so sessions and cache entries are never shared across keys"""
+    digest = hashlib.sha256(pem_bytes)
+    digest.update(b"\0" + (passphrase or "").encode())
+    return digest.hexdigest()
+
+class PrivateKeyCache:
+    """
+    In-process TTL cache of decoded DER key bytes keyed by a hash of
+    PEM + passphrase. Entries are held in bytearrays and overwritten
+    with zeros when they expire or are evicted.
+    """
 
-def get_snowflake_session_dynamic(account, user, role, warehouse, database, schema, private_key_path, private_key_passphrase=None):
+    def __init__(self, ttl=900, max_entries=32):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = {}   # fingerprint -> (bytearray, expires_at)
+
+    @staticmethod
+    def _zero(buf):
+        buf[:] = bytes(len(buf))
+
+    def _evict_expired(self):
+        now = time.monotonic()
+        for fp, (buf, expires_at) in list(self._entries.items()):
+            if expires_at <= now:
+                self._zero(buf)
+                del self._entries[fp]
+
+    def get(self, pem_bytes, passphrase=None):
+        fp = key_fingerprint(pem_bytes, passphrase)
+
+        with self._lock:
+            self._evict_expired()
+            entry = self._entries.get(fp)
+            if entry:
+                return bytes(entry[0])
+
+        # Decrypt outside the lock; PBKDF on encrypted keys is the slow part
+        der = bytearray(decode_private_key(pem_bytes, passphrase))
+
+        with self._lock:
+            if fp in self._entries:
+                self._zero(der)
+                return bytes(self._entries[fp][0])
+
+            while len(self._entries) >= self.max_entries:
+                oldest = min(self._entries, key=lambda k: self._entries[k][1])
+                self._zero(self._entries.pop(oldest)[0])
+
+            self._entries[fp] = (der, time.monotonic() + self.ttl)
+            return bytes(der)
+
+    def clear(self):
+        with self._lock:
+            for buf, _ in self._entries.values():
+                self._zero(buf)
+            self._entries.clear()
+
+KEY_CACHE = PrivateKeyCache(
+    ttl=int(os.getenv("PRIVATE_KEY_CACHE_TTL", "900")),
+    max_entries=int(os.getenv("PRIVATE_KEY_CACHE_MAX_ENTRIES", "32"))
+)
+
+def read_env_private_key():
+    with open(os.getenv("PRIVATE_KEY_PATH"), "rb") as f:
+        return f.read()
+
+# Upper bound for any statement on a backend session (0 = account default);
+# generated KPI / chart SQL gets the tighter SQL_STATEMENT_TIMEOUT
+SESSION_STATEMENT_TIMEOUT = int(os.getenv("SESSION_STATEMENT_TIMEOUT", "900"))
+
+def configure_session(session):
+    """Applies session-level safety settings to a freshly created session"""
+    if SESSION_STATEMENT_TIMEOUT:
+        session.sql(
+            f"ALTER SESSION SET STATEMENT_TIMEOUT_IN_SECONDS = {SESSION_STATEMENT_TIMEOUT}"
+        ).collect()
+    return session
+
+def get_snowflake_session_dynamic(account, user, role, warehouse, database, schema, private_key_pem, private_key_passphrase=None):
     """Create Snowflake session with dynamically provided credentials"""
     conn = snowflake.connector.connect(
         user=user,
         account=account,
-        private_key=load_private_key_bytes(
-            private_key_path,
+        private_key=KEY_CACHE.get(
+            private_key_pem,
             private_key_passphrase
         ),
         warehouse=warehouse,
@@ -137,68 +308,782 @@ def get_snowflake_session_dynamic(account, user, role, warehouse, database, sche
         schema=schema,
         role=role
     )
-    return Session.builder.configs({"connection": conn}).create()
+    return configure_session(Session.builder.configs({"connection": conn}).create())
+
+# =========================================================
+# SESSION POOL
+# =========================================================
+
+class SnowflakeSessionPool:
+    """
+    Bounded, thread-safe pool of Snowpark sessions keyed by
+    (account, user, role, warehouse, database, schema, key fingerprint).
+    Idle sessions expire after `idle_timeout` seconds and are health
+    checked before being handed out again.
+    """
+
+    def __init__(self, max_per_key=4, max_total=32, idle_timeout=300, acquire_timeout=60):
+        self.max_per_key = max_per_key
+        self.max_total = max_total
+        self.idle_timeout = idle_timeout
+        self.acquire_timeout = acquire_timeout
+        self._cond = threading.Condition()
+        self._idle = {}      # key -> [(session, last_used)]
+        self._in_use = {}    # key -> borrowed count
+
+    def _total(self):
+        return sum(self._in_use.values()) + sum(len(v) for v in self._idle.values())
+
+    def _count(self, key):
+        return self._in_use.get(key, 0) + len(self._idle.get(key, []))
+
+    def _evict_expired(self):
+        now = time.monotonic()
+        expired = []
+        for key, idle in list(self._idle.items()):
+            keep = [(s, ts) for s, ts in idle if now - ts < self.idle_timeout]
+            expired.extend(s for s, ts in idle if now - ts >= self.idle_timeout)
+            if keep:
+                self._idle[key] = keep
+            else:
+                del self._idle[key]
+        return expired
+
+    def _evict_oldest_idle(self):
+        oldest_key, oldest_ts = None, None
+        for key, idle in self._idle.items():
+            if idle and (oldest_ts is None or idle[0][1] < oldest_ts):
+                oldest_key, oldest_ts = key, idle[0][1]
+        if oldest_key is None:
+            return None
+        session, _ = self._idle[oldest_key].pop(0)
+        if not self._idle[oldest_key]:
+            del self._idle[oldest_key]
+        return session
+
+    @staticmethod
+    def _close(session):
+        try:
+            session.close()
+        except Exception:
+            pass
+
+    @staticmethod
+    def _is_healthy(session):
+        try:
+            session.sql("SELECT 1").collect()
+            return True
+        except Exception:
+            return False
+
+    def acquire(self, key, factory):
+        deadline = time.monotonic() + self.acquire_timeout
+
+        while True:
+            to_close = []
+            session = None
+            reserved = False
+            try:
+                with self._cond:
+                    to_close.extend(self._evict_expired())
+                    idle = self._idle.get(key)
+
+                    if idle:
+                        session, _ = idle.pop()
+                        if not idle:
+                            del self._idle[key]
+                        reserved = True
+                    elif self._count(key) < self.max_per_key:
+                        if self._total() >= self.max_total:
+                            victim = self._evict_oldest_idle()
+                            if victim is not None:
+                                to_close.append(victim)
+                                reserved = True
+                        else:
+                            reserved = True
+
+                    if reserved:
+                        self._in_use[key] = self._in_use.get(key, 0) + 1
+                    else:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            raise TimeoutError("Timed out waiting for a pooled Snowflake session")
+                        self._cond.wait(remaining)
+            finally:
+                for s in to_close:
+                    self._close(s)
+
+            if not reserved:
+                continue
+
+            if session is not None:
+                if self._is_healthy(session):
+                    return session
+                self._close(session)
+                self._release_slot(key)
+                continue
+
+            try:
+                return factory()
+            except Exception:
+                self._release_slot(key)
+                raise
+
+    def _release_slot(self, key):
+        with self._cond:
+            self._in_use[key] -= 1
+            if not self._in_use[key]:
+                del self._in_use[key]
+            self._cond.notify_all()
+
+    def release(self, key, session, discard=False):
+        if discard:
+            self._close(session)
+        else:
+            with self._cond:
+                self._idle.setdefault(key, []).append((session, time.monotonic()))
+        self._release_slot(key)
+
+    @contextmanager
+    def session(self, key, factory):
+        session = self.acquire(key, factory)
+        try:
+            yield session
+        finally:
+            self.release(key, session)
+
+    def close_all(self):
+        with self._cond:
+            sessions = [s for idle in self._idle.values() for s, _ in idle]
+            self._idle.clear()
+        for s in sessions:
+            self._close(s)
+
+SESSION_POOL = SnowflakeSessionPool(
+    max_per_key=int(os.getenv("SNOWFLAKE_POOL_MAX_PER_KEY", "4")),
+    max_total=int(os.getenv("SNOWFLAKE_POOL_MAX_TOTAL", "32")),
+    idle_timeout=int(os.getenv("SNOWFLAKE_POOL_IDLE_TIMEOUT", "300")),
+    acquire_timeout=int(os.getenv("SNOWFLAKE_POOL_ACQUIRE_TIMEOUT", "60"))
+)
+
+# Pool key of every pooled session, read by schema_cache_key()
+SESSION_KEYS = weakref.WeakKeyDictionary()
+
+@contextmanager
+def pooled_session(account, user, role, warehouse, database, schema, private_key_pem, private_key_passphrase=None):
+    """Borrow a Snowflake session from the pool with the given credentials"""
+    key = (
+        account, user, role, warehouse, database, schema,
+        key_fingerprint(private_key_pem, private_key_passphrase)
+    )
+    factory = lambda: get_snowflake_session_dynamic(
+        account, user, role, warehouse, database, schema,
+        private_key_pem, private_key_passphrase
+    )
+    with SESSION_POOL.session(key, factory) as session:
+        SESSION_KEYS[session] = key
+        yield session
+
+def pooled_env_session():
+    """Borrow a Snowflake session from the pool using .env credentials"""
+    return pooled_session(
+        os.getenv("SNOWFLAKE_ACCOUNT"),
+        os.getenv("SNOWFLAKE_USER"),
+        os.getenv("SNOWFLAKE_ROLE"),
+        os.getenv("SNOWFLAKE_WAREHOUSE"),
+        os.getenv("SNOWFLAKE_DATABASE"),
+        os.getenv("SNOWFLAKE_SCHEMA"),
+        read_env_private_key(),
+        os.getenv("PRIVATE_KEY_PASSPHRASE")
+    )
+
+# =========================================================
+# CORTEX RESPONSE CACHE
+# =========================================================
+
+class CortexResponseCache:
+    """
+    Two-tier cache of raw Cortex completions keyed by
+    (model, normalized prompt hash): an in-process LRU with
+    size and TTL limits, backed by a local SQLite file.
+    """
+
+    def __init__(self, path=None, max_entries=512, ttl=86400):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._lru = OrderedDict()   # key -> (response, expires_at)
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS CORTEX_CACHE (
+                    CACHE_KEY TEXT PRIMARY KEY,
+                    MODEL TEXT,
+                    RESPONSE TEXT,
+                    EXPIRES_AT REAL
+                )
+            """)
+            self._db.commit()
+
+    @staticmethod
+    def cache_key(model, prompt):
+        normalized = " ".join(prompt.split())
+        return f"{model}:{hashlib.sha256(normalized.encode()).hexdigest()}"
+
+    def _remember(self, key, response, expires_at):
+        self._lru[key] = (response, expires_at)
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.max_entries:
+            self._lru.popitem(last=False)
+
+    def get(self, model, prompt):
+        key = self.cache_key(model, prompt)
+        now = time.time()
+
+        with self._lock:
+            entry = self._lru.get(key)
+            if entry and entry[1] > now:
+                self._lru.move_to_end(key)
+                self.memory_hits += 1
+                return entry[0]
+            self._lru.pop(key, None)
+
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT RESPONSE, EXPIRES_AT FROM CORTEX_CACHE WHERE CACHE_KEY = ?", (key,)
+                ).fetchone()
+                if row and row[1] > now:
+                    self._remember(key, row[0], row[1])
+                    self.disk_hits += 1
+                    return row[0]
+                if row:
+                    self._db.execute("DELETE FROM CORTEX_CACHE WHERE CACHE_KEY = ?", (key,))
+                    self._db.commit()
+
+            self.misses += 1
+            return None
+
+    def put(self, model, prompt, response):
+        key = self.cache_key(model, prompt)
+        expires_at = time.time() + self.ttl
+
+        with self._lock:
+            self._remember(key, response, expires_at)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO CORTEX_CACHE (CACHE_KEY, MODEL, RESPONSE, EXPIRES_AT) VALUES (?, ?, ?, ?)",
+                    (key, model, response, expires_at)
+                )
+                self._db.commit()
+
+    def stats(self):
+        with self._lock:
+            hits = self.memory_hits + self.disk_hits
+            lookups = hits + self.misses
+            return {
+                "hits": hits,
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": round(hits / lookups, 3) if lookups else None,
+                "memory_entries": len(self._lru)
+            }
+
+CORTEX_CACHE = CortexResponseCache(
+    path=os.getenv(
+        "CORTEX_CACHE_PATH",
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cortex_cache.sqlite3")
+    ),
+    max_entries=int(os.getenv("CORTEX_CACHE_MAX_ENTRIES", "512")),
+    ttl=int(os.getenv("CORTEX_CACHE_TTL", "86400"))
+)
 
 class BaseAgent:
-    def __init__(self, session, model="mistral-large2"):
+    def __init__(self, session, model="mistral-large2", use_cache=True):
         self.session = session
         self.model = model
+        self.use_cache = use_cache
 
     def cortex(self, prompt):
-        res = self.session.sql(f"""
-            SELECT SNOWFLAKE.CORTEX.COMPLETE(
-                '{self.model}',
-                '{prompt.replace("'", "''")}'
-            ) AS RESPONSE
-        """).collect()
+        if self.use_cache:
+            cached = CORTEX_CACHE.get(self.model, prompt)
+            if cached is not None:
+                return extract_json(cached)
+
+        res = self.session.sql("""
+            SELECT SNOWFLAKE.CORTEX.COMPLETE(%s, %s) AS RESPONSE
+        """, params=[self.model, prompt]).collect()
+
+        raw = res[0]["RESPONSE"] if res else None
+        parsed = extract_json(raw)
+
+        # Only well-formed answers are worth replaying
+        if parsed and self.use_cache:
+            CORTEX_CACHE.put(self.model, prompt, raw)
+
+        return parsed
+
+    def run(self, metadata):
+        return self.cortex(self.prompt(metadata))
+
+def cortex_batch(session, prompts, model="mistral-large2", use_cache=True):
+    """
+    Sends several agents' prompts to Cortex in ONE statement.
+    prompts: {agent name: prompt}
+    Returns {agent name: parsed JSON response}.
+    Cached prompts are answered locally and left out of the statement.
+    """
+    responses = {}
+    misses = []
+    for name, prompt in prompts.items():
+        cached = CORTEX_CACHE.get(model, prompt) if use_cache else None
+        if cached is not None:
+            responses[name] = extract_json(cached)
+        else:
+            misses.append(name)
+
+    if misses:
+        params = [model]
+        for name in misses:
+            params.extend([name, prompts[name]])
+
+        res = session.sql(f"""
+            SELECT t.AGENT, SNOWFLAKE.CORTEX.COMPLETE(%s, t.PROMPT) AS RESPONSE
+            FROM VALUES {", ".join(["(%s, %s)"] * len(misses))} AS t(AGENT, PROMPT)
+        """, params=params).collect()
+
+        for r in res:
+            parsed = extract_json(r["RESPONSE"])
+            responses[r["AGENT"]] = parsed
+            if parsed and use_cache:
+                CORTEX_CACHE.put(model, prompts[r["AGENT"]], r["RESPONSE"])
+
+    return {name: responses.get(name, {}) for name in prompts}
+
+# =========================================================
+# SCHEMA PROMPT SHARDING
+# =========================================================
+
+SCHEMA_PROMPT_TOKEN_BUDGET = int(os.getenv("SCHEMA_PROMPT_TOKEN_BUDGET", "4000"))
+SCHEMA_SHARD_CONCURRENCY = session_workers(int(os.getenv("SCHEMA_SHARD_CONCURRENCY", "4")))
+
+TYPE_ABBREVIATIONS = {
+    "NUMBER": "num", "FLOAT": "float", "TEXT": "str", "BOOLEAN": "bool",
+    "DATE": "date", "TIME": "time", "TIMESTAMP_NTZ": "ts", "TIMESTAMP_LTZ": "tsl",
+    "TIMESTAMP_TZ": "tstz", "VARIANT": "var", "OBJECT": "obj", "ARRAY": "arr",
+    "BINARY": "bin", "GEOGRAPHY": "geo", "GEOMETRY": "geom"
+}
+
+SCHEMA_LEGEND = (
+    "One table per line as TABLE: column:type. Types: "
+    + ", ".join(f"{short}={full}" for full, short in TYPE_ABBREVIATIONS.items())
+)
+
+def estimate_tokens(text):
+    return len(text) // 4 + 1
+
+def compact_table(table, cols):
+    return f"{table}: " + ", ".join(
+        f"{c['column']}:{TYPE_ABBREVIATIONS.get(str(c['type']).upper(), str(c['type']).lower())}"
+        for c in cols
+    )
+
+def compact_schema(metadata):
+    """Token-lean rendering of {table: [{"column", "type"}]} for prompts"""
+    return SCHEMA_LEGEND + "\n" + "\n".join(
+        compact_table(t, cols) for t, cols in metadata.items()
+    )
+
+def shard_schema(metadata, token_budget=4000, extra_cost=None):
+    """
+    Splits metadata into table-order shards whose compact encoding, plus
+    extra_cost(table) tokens per table when given, fits token_budget.
+    A table that alone exceeds the budget gets its own shard.
+    """
+    shards, shard, used = [], {}, 0
+    for table, cols in metadata.items():
+        cost = estimate_tokens(compact_table(table, cols)) + (extra_cost(table) if extra_cost else 0)
+        if shard and used + cost > token_budget:
+            shards.append(shard)
+            shard, used = {}, 0
+        shard[table] = cols
+        used += cost
+    if shard or not shards:
+        shards.append(shard)
+    return shards
+
+def round_robin(lists):
+    """Interleaves lists so every shard contributes before any repeats"""
+    merged = []
+    for i in range(max((len(l) for l in lists), default=0)):
+        merged.extend(l[i] for l in lists if i < len(l))
+    return merged
+
+class SchemaAgent(BaseAgent):
+    """
+    Schema-level generator. Wide schemas are split into shards that fit
+    SCHEMA_PROMPT_TOKEN_BUDGET; each shard is prompted separately and the
+    JSON answers are merged round-robin and de-duplicated.
+    """
+
+    result_key = None       # list in the response holding the items
+    max_items = None        # cap on merged items, None keeps all
+
+    def schema_view(self, metadata):
+        """The part of the schema the prompt needs"""
+        return metadata
+
+    def prompts(self, metadata):
+        return [self.prompt(shard) for shard in shard_schema(
+            self.schema_view(metadata), SCHEMA_PROMPT_TOKEN_BUDGET
+        )]
+
+    def dedupe_key(self, item):
+        return json.dumps(item, sort_keys=True, default=str)
+
+    def merge(self, responses):
+        if len(responses) == 1:
+            return responses[0]
+
+        items, seen = [], set()
+        for item in round_robin([
+            [i for i in (r or {}).get(self.result_key, []) if isinstance(i, dict)]
+            for r in responses
+        ]):
+            key = self.dedupe_key(item)
+            if key not in seen:
+                seen.add(key)
+                items.append(item)
+        return {self.result_key: items[:self.max_items] if self.max_items else items}
+
+    def run(self, metadata):
+        return self.merge(run_concurrently(
+            self.cortex, self.prompts(metadata), SCHEMA_SHARD_CONCURRENCY
+        ))
+
+# =========================================================
+# SCHEMA METADATA CACHE
+# =========================================================
+
+class SchemaMetadataCache:
+    """
+    Column metadata cached per schema_cache_key() scope.
+    Each table's columns are stored with the LAST_ALTERED version
+    they were read at and are re-read only when it changes.
+    The version listing itself is reused for `version_max_age` seconds,
+    so /list-tables followed by /run-analysis reads the catalog once.
+    """
+
+    def __init__(self, version_max_age=60, max_schemas=32):
+        self.version_max_age = version_max_age
+        self.max_schemas = max_schemas
+        self._lock = threading.Lock()
+        self._schemas = OrderedDict()   # schema key -> {"versions", "read_at", "columns"}
+
+    def _entry(self, key):
+        entry = self._schemas.get(key)
+        if entry is None:
+            entry = {"versions": None, "read_at": 0, "columns": {}}
+            self._schemas[key] = entry
+            while len(self._schemas) > self.max_schemas:
+                self._schemas.popitem(last=False)
+        self._schemas.move_to_end(key)
+        return entry
+
+    def record_versions(self, key, versions):
+        with self._lock:
+            entry = self._entry(key)
+            entry["versions"] = versions
+            entry["read_at"] = time.monotonic()
+
+    def table_versions(self, key, loader):
+        with self._lock:
+            entry = self._entry(key)
+            if entry["versions"] is not None and time.monotonic() - entry["read_at"] < self.version_max_age:
+                return entry["versions"]
+
+        versions = loader()
+        self.record_versions(key, versions)
+        return versions
+
+    def stale_tables(self, key, versions, tables):
+        with self._lock:
+            columns = self._entry(key)["columns"]
+            return [t for t in tables if t not in columns or columns[t][0] != versions.get(t)]
+
+    def store_columns(self, key, versions, columns_by_table):
+        with self._lock:
+            columns = self._entry(key)["columns"]
+            for table, cols in columns_by_table.items():
+                columns[table] = (versions.get(table), cols)
+
+    def columns(self, key, tables):
+        with self._lock:
+            columns = self._entry(key)["columns"]
+            return {t: columns[t][1] for t in tables if t in columns}
+
+METADATA_CACHE = SchemaMetadataCache(
+    version_max_age=int(os.getenv("METADATA_VERSION_MAX_AGE", "60"))
+)
+
+def schema_cache_key(session):
+    """
+    Scope of cached metadata, column statistics and query results:
+    account, user, role, database, schema and key fingerprint, so what
+    one role was allowed to see is never served to another.
+    """
+    key = SESSION_KEYS.get(session)
+    if key is not None:
+        account, user, role, _warehouse, database, schema, fingerprint = key
+        return (account, user, role, database, schema, fingerprint)
+    return (
+        session.get_current_account(),
+        session.connection.user,
+        session.get_current_role(),
+        session.get_current_database(),
+        session.get_current_schema(),
+        None
+    )
 
-        return extract_json(res[0]["RESPONSE"]) if res else {}
+def fetch_table_versions(session):
+    """{table: LAST_ALTERED} for every table and view in the current schema"""
+    rows = session.sql("""
+        SELECT TABLE_NAME, LAST_ALTERED
+        FROM INFORMATION_SCHEMA.TABLES
+        WHERE TABLE_SCHEMA = CURRENT_SCHEMA()
+        ORDER BY TABLE_NAME
+    """).collect()
+    return {r["TABLE_NAME"]: r["LAST_ALTERED"] for r in rows}
 
 class MetadataAgent:
     def __init__(self, session):
         self.session = session
 
     def run(self, selected_tables=None):
-        df = self.session.sql("""
+        key = schema_cache_key(self.session)
+        versions = METADATA_CACHE.table_versions(key, lambda: fetch_table_versions(self.session))
+
+        tables = [t for t in versions if not selected_tables or t in selected_tables]
+
+        stale = METADATA_CACHE.stale_tables(key, versions, tables)
+        if stale:
+            print(f"   🔄 Reading column metadata for {len(stale)} table(s)")
+            columns = self._read_columns(stale, filtered=len(stale) < len(versions))
+            METADATA_CACHE.store_columns(key, versions, columns)
+
+        return METADATA_CACHE.columns(key, tables)
+
+    def _read_columns(self, tables, filtered=True):
+        table_filter = f"AND TABLE_NAME IN ({', '.join(['%s'] * len(tables))})" if filtered else ""
+
+        df = self.session.sql(f"""
             SELECT TABLE_NAME, COLUMN_NAME, DATA_TYPE
             FROM INFORMATION_SCHEMA.COLUMNS
             WHERE TABLE_SCHEMA = CURRENT_SCHEMA()
-        """).to_pandas()
+            {table_filter}
+            ORDER BY TABLE_NAME, ORDINAL_POSITION
+        """, params=tables if filtered else None).to_pandas()
+
+        df = df.rename(columns={"COLUMN_NAME": "column", "DATA_TYPE": "type"})
+        return {
+            table: group[["column", "type"]].to_dict(orient="records")
+            for table, group in df.groupby("TABLE_NAME", sort=False)
+        }
 
-        meta = {}
-        for _, r in df.iterrows():
-            table_name = r["TABLE_NAME"]
-            # Filter by selected tables if provided
-            if selected_tables and table_name not in selected_tables:
-                continue
-            meta.setdefault(table_name, []).append({
-                "column": r["COLUMN_NAME"],
-                "type": r["DATA_TYPE"]
-            })
-        return meta
+PROFILE_MAX_CONCURRENCY = session_workers(int(os.getenv("PROFILE_MAX_CONCURRENCY", "4")))
+
+def table_versions(table_stats):
+    """
+    {table: LAST_ALTERED} from fetch_table_stats() output. Views get no
+    version: their LAST_ALTERED tracks the definition, not the data.
+    """
+    return {
+        t: s.get("last_altered") if s.get("table_type") == "BASE TABLE" else None
+        for t, s in (table_stats or {}).items()
+    }
+
+def row_counts(table_stats):
+    """
+    {TABLE: row count} for base tables, from fetch_table_stats() or
+    DataProfilerAgent output. Views are left out: they cannot be
+    block-sampled, so they are always read exactly.
+    """
+    return {
+        t.upper(): s.get("row_count")
+        for t, s in (table_stats or {}).items()
+        if s.get("table_type", "BASE TABLE") == "BASE TABLE"
+    }
+
+def fetch_table_stats(session, tables):
+    """
+    Row count, bytes and LAST_ALTERED for the given tables
+    from ONE INFORMATION_SCHEMA.TABLES query.
+    """
+    tables = list(tables)
+    if not tables:
+        return {}
+
+    rows = session.sql(f"""
+        SELECT TABLE_NAME, TABLE_TYPE, ROW_COUNT, BYTES, LAST_ALTERED
+        FROM INFORMATION_SCHEMA.TABLES
+        WHERE TABLE_SCHEMA = CURRENT_SCHEMA()
+          AND TABLE_NAME IN ({", ".join(["%s"] * len(tables))})
+    """, params=tables).collect()
+
+    return {
+        r["TABLE_NAME"]: {
+            "table_type": r["TABLE_TYPE"],
+            "row_count": r["ROW_COUNT"],
+            "bytes": r["BYTES"],
+            "last_altered": r["LAST_ALTERED"]
+        }
+        for r in rows
+    }
 
 class DataProfilerAgent:
     def __init__(self, session):
         self.session = session
 
-    def run(self, tables):
-        profile = {}
-        for t in list(tables)[:15]:
+    def run(self, tables, stats=None):
+        """
+        Row counts come from table metadata, so profiling cost does not
+        grow with table size. Views and other objects without metadata
+        counts fall back to concurrent COUNT(*) queries.
+        """
+        tables = list(tables)
+
+        if stats is None:
             try:
-                cnt = self.session.sql(f"SELECT COUNT(*) FROM {t}").collect()[0][0]
-                profile[t] = {"row_count": cnt}
+                stats = fetch_table_stats(self.session, tables)
             except Exception:
-                profile[t] = {"row_count": None}
+                stats = {}
+
+        profile = {t: stats.get(t, {"row_count": None}) for t in tables}
+
+        needs_count = [t for t in tables if profile[t].get("row_count") is None]
+        counts = run_concurrently(self._count_rows, needs_count, PROFILE_MAX_CONCURRENCY)
+        for t, cnt in zip(needs_count, counts):
+            profile[t] = {**profile[t], "row_count": cnt}
+
         return profile
 
-class DataQualityScopeAgent(BaseAgent):
-    def run(self, metadata):
+    def _count_rows(self, table):
+        try:
+            return self.session.sql(f"SELECT COUNT(*) FROM {table}").collect()[0][0]
+        except Exception:
+            return None
+
+# =========================================================
+# APPROXIMATE MODE
+# =========================================================
+
+# Tables above APPROX_ROW_THRESHOLD rows (0 disables) are read through
+# SAMPLE SYSTEM sized to about APPROX_SAMPLE_ROWS rows
+APPROX_ROW_THRESHOLD = int(os.getenv("APPROX_ROW_THRESHOLD", "100000000"))
+APPROX_SAMPLE_ROWS = int(os.getenv("APPROX_SAMPLE_ROWS", "10000000"))
+
+# Relative standard error of Snowflake's HyperLogLog distinct counts
+HLL_RELATIVE_ERROR = 0.01623
+
+AGGREGATE_FUNCTIONS = {
+    "SUM", "COUNT", "AVG", "MIN", "MAX", "MEDIAN", "MODE", "LISTAGG", "ARRAY_AGG",
+    "OBJECT_AGG", "STDDEV", "STDDEV_POP", "STDDEV_SAMP", "VARIANCE", "VAR_POP",
+    "VAR_SAMP", "PERCENTILE_CONT", "PERCENTILE_DISC", "ANY_VALUE", "COUNT_IF",
+    "APPROX_COUNT_DISTINCT", "HLL", "APPROX_TOP_K", "APPROX_PERCENTILE", "KURTOSIS",
+    "SKEW", "CORR", "COVAR_POP", "COVAR_SAMP"
+}
+
+SIMPLE_AGGREGATE_SQL = re.compile(
+    r"^\s*SELECT\s+(?P<select>.+?)\s+FROM\s+(?P<table>[\w$.\"]+)"
+    r"(?P<rest>(?:\s+(?:WHERE|GROUP\s+BY|ORDER\s+BY|LIMIT)\b.*)?)\s*;?\s*$",
+    re.IGNORECASE | re.DOTALL
+)
+
+def sample_percent(row_count):
+    """SAMPLE SYSTEM percentage for a table, or None when it is read exactly"""
+    if not APPROX_ROW_THRESHOLD or not row_count or row_count <= APPROX_ROW_THRESHOLD:
+        return None
+    return max(round(100.0 * APPROX_SAMPLE_ROWS / row_count, 6), 0.000001)
+
+def scale_aggregates(select, factor):
+    """
+    Wraps every SUM(...) / COUNT(...) in the select list as (... * factor);
+    SUM(DISTINCT ...) / COUNT(DISTINCT ...) are left as they are
+    """
+    out, i = [], 0
+    for m in re.finditer(r"\b(SUM|COUNT)\s*\((?!\s*DISTINCT\b)", select, re.IGNORECASE):
+        if m.start() < i:
+            continue  # nested inside an aggregate already wrapped
+        depth, j = 0, m.end() - 1
+        while j < len(select):
+            depth += {"(": 1, ")": -1}.get(select[j], 0)
+            if depth == 0:
+                break
+            j += 1
+        out.append(select[i:m.start()] + f"({select[m.start():j + 1]} * {factor})")
+        i = j + 1
+    return "".join(out) + select[i:]
+
+def approximate_sql(sql, row_counts, percent=None):
+    """
+    Rewrites a simple single-table SUM / COUNT / AVG statement over a
+    table above APPROX_ROW_THRESHOLD to read a SAMPLE SYSTEM of it, with
+    SUM and COUNT scaled back up. Aggregates over DISTINCT values do not
+    scale and are always read exactly. `percent` forces the sample size
+    regardless of the row count. Returns (sql, None) when the statement
+    is read exactly, else (rewritten sql, approximation details).
+    """
+    m = SIMPLE_AGGREGATE_SQL.match(sql or "")
+    if not m or not (row_counts or percent):
+        return sql, None
+
+    select, table = m.group("select"), m.group("table")
+    rest = m.group("rest").rstrip().rstrip(";")
+    upper = (select + " " + rest).upper()
+    functions = set(re.findall(r"\b([A-Z_]+)\s*\(", upper))
+    if (
+        re.search(r"\b(SELECT|JOIN|HAVING|QUALIFY|OVER|SAMPLE|TABLESAMPLE)\b", upper)
+        or re.search(r"\b[A-Z_]+\s*\(\s*DISTINCT\b", upper)
+        or not functions & {"SUM", "COUNT", "AVG"}
+        or functions & (AGGREGATE_FUNCTIONS - {"SUM", "COUNT", "AVG"})
+    ):
+        return sql, None
+
+    row_count = (row_counts or {}).get(re.split(r"\s*\.\s*", table)[-1].strip('"').upper())
+    if percent is None:
+        percent = sample_percent(row_count)
+    if percent is None:
+        return sql, None
+
+    factor = round(100.0 / percent, 6)
+    rewritten = f"SELECT {scale_aggregates(select, factor)} FROM {table} SAMPLE SYSTEM ({percent}){rest}"
+    return rewritten, {
+        "method": "sample",
+        "sample_percent": percent,
+        # Unknown: it depends on how many sampled rows match WHERE / each
+        # group, and SAMPLE SYSTEM reads whole blocks of correlated rows
+        "estimated_relative_error": None,
+        "sql": rewritten
+    }
+
+class DataQualityScopeAgent(SchemaAgent):
+    result_key = "checks"
+
+    def dedupe_key(self, item):
+        return (item.get("table"), item.get("column"), item.get("check_type"))
+
+    def prompt(self, metadata):
         """
         Cortex decides WHICH tables and columns
         are candidates for data quality checks.
         """
 
-        return self.cortex(f"""
+        return f"""
 Return STRICT JSON ONLY.
 
 You are a senior Data Quality architect.
@@ -216,7 +1101,7 @@ Rules:
 - Dates: DATE, TIME, TS, CREATED, UPDATED columns
 
 Metadata:
-{json.dumps(metadata)}
+{compact_schema(metadata)}
 
 Output format:
 {{
@@ -228,93 +1113,477 @@ Output format:
     }}
   ]
 }}
-""")
+"""
+
+DQ_SCOPE_LLM = os.getenv("DQ_SCOPE_LLM", "off").lower()  # off | augment
+
+def env_patterns(name, default):
+    return [p.strip().upper() for p in os.getenv(name, default).split(",") if p.strip()]
+
+# Column name globs for each rule-based check
+DQ_DUPLICATE_PATTERNS = env_patterns("DQ_DUPLICATE_PATTERNS", "*_ID,*_KEY,*EMAIL*,*USER*,*CUSTOMER*")
+DQ_DATE_PATTERNS = env_patterns("DQ_DATE_PATTERNS", "*DATE*,*TIME*,*_TS,TS_*,*_AT,*_DT,*CREATED*,*UPDATED*")
+DQ_MISSING_PATTERNS = env_patterns("DQ_MISSING_PATTERNS", "*")
+
+TEMPORAL_TYPES = ("DATE", "TIMESTAMP", "TIMESTAMP_NTZ", "TIMESTAMP_LTZ", "TIMESTAMP_TZ", "DATETIME")
+
+def matches_any(column, patterns):
+    return any(fnmatch.fnmatchcase(column.upper(), p) for p in patterns)
+
+def is_metric(column):
+    """Numeric column that is not an *_ID / *_KEY key"""
+    return type_family(column["type"]) == "number" and not KEY_COLUMN.search(column["column"].upper())
+
+def rule_dq_scope(metadata):
+    """
+    The DataQualityScopeAgent rules applied locally: duplicate checks on
+    key-like columns, future-date checks on date/time columns and
+    missing-value checks on metrics, by DQ_*_PATTERNS.
+    """
+    checks = []
+    for table, cols in metadata.items():
+        for c in cols:
+            column = c["column"]
+            if is_metric(c) and matches_any(column, DQ_MISSING_PATTERNS):
+                checks.append({"table": table, "column": column, "check_type": "missing_values"})
+            if matches_any(column, DQ_DUPLICATE_PATTERNS):
+                checks.append({"table": table, "column": column, "check_type": "duplicates"})
+            if matches_any(column, DQ_DATE_PATTERNS):
+                checks.append({"table": table, "column": column, "check_type": "invalid_dates"})
+    return {"checks": checks}
+
+def validate_dq_scope(dq_scope, metadata):
+    """
+    Keeps checks on real columns (names canonicalized), known check
+    types and, for invalid_dates, DATE / TIMESTAMP columns only.
+    """
+    columns = {
+        table.upper(): (table, {c["column"].upper(): c for c in cols})
+        for table, cols in metadata.items()
+    }
+    valid, seen, dropped = [], set(), 0
+    for item in (dq_scope or {}).get("checks", []):
+        if not isinstance(item, dict):
+            dropped += 1
+            continue
+        table, cols = columns.get(str(item.get("table", "")).upper(), (None, {}))
+        col = cols.get(str(item.get("column", "")).upper())
+        check = item.get("check_type")
+        if (
+            not col or check not in DQ_CHECK_EXPRESSIONS
+            or (check == "invalid_dates" and str(col["type"]).upper() not in TEMPORAL_TYPES)
+        ):
+            dropped += 1
+            continue
+        key = (table, col["column"], check)
+        if key not in seen:
+            seen.add(key)
+            valid.append({"table": table, "column": col["column"], "check_type": check})
+
+    if dropped:
+        print(f"   ℹ️  Dropped {dropped} data quality check(s) on unknown columns or types")
+    return {"checks": valid}
+
+DQ_MAX_CONCURRENCY = session_workers(int(os.getenv("DQ_MAX_CONCURRENCY", "4")))
+
+DQ_CHECK_EXPRESSIONS = {
+    "missing_values": "SUM(CASE WHEN {column} IS NULL THEN 1 ELSE 0 END)",
+    "duplicates": "COUNT(*) - COUNT(DISTINCT {column})",
+    "invalid_dates": "SUM(CASE WHEN {column} > CURRENT_TIMESTAMP() THEN 1 ELSE 0 END)",
+}
 
 class DataQualityProfiler:
-    def __init__(self, session):
+    def __init__(self, session, row_counts=None):
         self.session = session
+        self.row_counts = row_counts or {}
 
     def run(self, dq_scope):
         """
         Executes SQL checks ONLY on columns
         selected by Cortex.
+        All checks for a table are fused into one aggregate
+        statement, and tables are profiled concurrently.
         """
 
-        signals = []
-
+        by_table = {}
         for item in dq_scope.get("checks", []):
-            table = item["table"]
-            column = item["column"]
-            check = item["check_type"]
+            table = item.get("table")
+            column = item.get("column")
+            check = item.get("check_type")
+            if not table or not column or check not in DQ_CHECK_EXPRESSIONS:
+                continue
+            checks = by_table.setdefault(table, [])
+            if (column, check) not in checks:
+                checks.append((column, check))
+
+        results = run_concurrently(
+            lambda entry: self._profile_table(*entry),
+            list(by_table.items()),
+            DQ_MAX_CONCURRENCY
+        )
+        return [signal for signals in results for signal in signals]
 
-            try:
-                if check == "missing_values":
-                    res = self.session.sql(f"""
-                        SELECT COUNT(*) AS total,
-                               SUM(CASE WHEN {column} IS NULL THEN 1 ELSE 0 END) AS nulls
-                        FROM {table}
-                    """).collect()[0]
-
-                    if res["NULLS"] > 0:
-                        signals.append({
-                            "table": table,
-                            "column": column,
-                            "signal": "missing_values",
-                            "count": res["NULLS"]
-                        })
+    def _profile_table(self, table, checks):
+        percent = sample_percent(self.row_counts.get(table.upper()))
+        if percent is not None:
+            return self._profile_table_approx(table, checks, percent)
 
-                elif check == "duplicates":
-                    dup = self.session.sql(f"""
-                        SELECT COUNT(*) - COUNT(DISTINCT {column})
-                        FROM {table}
-                    """).collect()[0][0]
+        expressions = [
+            DQ_CHECK_EXPRESSIONS[check].format(column=column)
+            for column, check in checks
+        ]
 
-                    if dup > 0:
-                        signals.append({
-                            "table": table,
-                            "column": column,
-                            "signal": "duplicates",
-                            "count": dup
-                        })
+        try:
+            row = self.session.sql(f"""
+                SELECT {", ".join(f"{e} AS C{i}" for i, e in enumerate(expressions))}
+                FROM {table}
+            """).collect()[0]
+            counts = [row[i] for i in range(len(expressions))]
+        except Exception:
+            # One bad column fails the fused statement; fall back to per-check queries
+            counts = []
+            for e in expressions:
+                try:
+                    counts.append(self.session.sql(f"SELECT {e} FROM {table}").collect()[0][0])
+                except Exception:
+                    counts.append(None)
+
+        signals = []
+        for (column, check), count in zip(checks, counts):
+            if count and count > 0:
+                signals.append({
+                    "table": table,
+                    "column": column,
+                    "signal": check,
+                    "count": count
+                })
+        return signals
 
-                elif check == "invalid_dates":
-                    future = self.session.sql(f"""
-                        SELECT COUNT(*)
-                        FROM {table}
-                        WHERE {column} > CURRENT_TIMESTAMP()
-                    """).collect()[0][0]
+    def _profile_table_approx(self, table, checks, percent):
+        """
+        Null and future-date counts come from SAMPLE SYSTEM (percent),
+        scaled to the table's row count; their error is unknown (None)
+        because SAMPLE SYSTEM reads whole blocks of correlated rows.
+        Duplicates compare the row count with APPROX_COUNT_DISTINCT over
+        the full table and carry the 95% HLL margin; an estimate within
+        that margin is reported as count 0, no significant duplicates.
+        """
+        row_count = self.row_counts[table.upper()]
+        sampled = [(c, k) for c, k in checks if k != "duplicates"]
+        distinct = [(c, k) for c, k in checks if k == "duplicates"]
+        signals = []
 
-                    if future > 0:
+        if sampled:
+            exprs = ", ".join(
+                f"{DQ_CHECK_EXPRESSIONS[k].format(column=c)} AS C{i}" for i, (c, k) in enumerate(sampled)
+            )
+            try:
+                row = self.session.sql(
+                    f"SELECT COUNT(*) AS N, {exprs} FROM {table} SAMPLE SYSTEM ({percent})"
+                ).collect()[0]
+            except Exception as e:
+                print(f"   ⚠️  Sampled DQ checks failed for {table}: {str(e)}")
+                row = None
+            if row and row["N"]:
+                scale = row_count / row["N"]
+                for i, (column, check) in enumerate(sampled):
+                    count = row[f"C{i}"] or 0
+                    if count > 0:
                         signals.append({
-                            "table": table,
-                            "column": column,
-                            "signal": "invalid_dates",
-                            "count": future
+                            "table": table, "column": column, "signal": check,
+                            "count": round(count * scale),
+                            "approximate": True,
+                            "method": "sample",
+                            "sample_percent": percent,
+                            "error": None
                         })
 
-            except Exception:
-                continue
-
+        if distinct:
+            exprs = ", ".join(f"APPROX_COUNT_DISTINCT({c}) AS C{i}" for i, (c, _) in enumerate(distinct))
+            try:
+                row = self.session.sql(f"SELECT {exprs} FROM {table}").collect()[0]
+            except Exception as e:
+                print(f"   ⚠️  Approximate duplicate checks failed for {table}: {str(e)}")
+                row = None
+            for i, (column, check) in enumerate(distinct if row else []):
+                estimate = row[f"C{i}"] or 0
+                count = max(row_count - estimate, 0)
+                error = round(1.96 * HLL_RELATIVE_ERROR * estimate)
+                if count > 0:
+                    signals.append({
+                        "table": table, "column": column, "signal": check,
+                        # Within the HLL error (e.g. a unique key) nothing can be told apart
+                        "count": count if count > error else 0,
+                        "approximate": True,
+                        "method": "approx_count_distinct",
+                        "error": error
+                    })
         return signals
 
-class RelationshipAgent(BaseAgent):
-    def run(self, metadata):
-        small_schema = dict(list(metadata.items())[:10])
-        return self.cortex(f"""
+class RelationshipAgent(SchemaAgent):
+    result_key = "relationships"
+
+    def schema_view(self, metadata):
+        """Only key-like columns, so every table fits and joins across shards stay visible"""
+        keys = {
+            t: [c for c in cols if re.search(r"(^|_)(ID|KEY)$", c["column"].upper())]
+            for t, cols in metadata.items()
+        }
+        keys = {t: cols for t, cols in keys.items() if cols}
+        return keys or metadata
+
+    def dedupe_key(self, item):
+        tables = tuple(sorted([str(item.get("table1")), str(item.get("table2"))]))
+        return tables + (str(item.get("relationship", "")).upper(),)
+
+    def prompt(self, metadata):
+        return f"""
 Return STRICT JSON ONLY.
 
 Infer relationships using *_ID columns.
 
 Schema:
-{json.dumps(small_schema)}
+{compact_schema(metadata)}
 
 Format:
 {{ "relationships": [{{ "table1":"", "table2":"", "relationship":"" }}] }}
-""")
+"""
 
-class KPIGeneratorAgent(BaseAgent):
-    def run(self, metadata):
-        return self.cortex(f"""
+# =========================================================
+# RELATIONSHIP INFERENCE
+# =========================================================
+
+RELATIONSHIP_LLM_MODE = os.getenv("RELATIONSHIP_LLM_MODE", "fallback").lower()  # off | fallback | augment
+RELATIONSHIP_SAMPLE_ROWS = int(os.getenv("RELATIONSHIP_SAMPLE_ROWS", "100000"))
+RELATIONSHIP_KEY_SAMPLE = int(os.getenv("RELATIONSHIP_KEY_SAMPLE", "1000"))
+RELATIONSHIP_MIN_CONTAINMENT = float(os.getenv("RELATIONSHIP_MIN_CONTAINMENT", "0.9"))
+RELATIONSHIP_MAX_CONCURRENCY = session_workers(int(os.getenv("RELATIONSHIP_MAX_CONCURRENCY", "4")))
+
+TABLE_NAME_PREFIXES = ("DIM_", "FACT_", "FCT_", "TBL_", "STG_")
+
+def type_family(data_type):
+    t = str(data_type).upper()
+    if t in ("NUMBER", "DECIMAL", "NUMERIC", "INT", "INTEGER", "BIGINT", "SMALLINT", "FLOAT", "DOUBLE", "REAL"):
+        return "number"
+    if t in ("TEXT", "VARCHAR", "STRING", "CHAR"):
+        return "text"
+    return t
+
+def entity_names(table):
+    """ORDERS -> {ORDERS, ORDER}; DIM_CUSTOMER -> {DIM_CUSTOMER, CUSTOMER}"""
+    names = {table.upper()}
+    for prefix in TABLE_NAME_PREFIXES:
+        if table.upper().startswith(prefix):
+            names.add(table.upper()[len(prefix):])
+    for name in list(names):
+        if name.endswith("IES"):
+            names.add(name[:-3] + "Y")
+        elif name.endswith(("SES", "XES")):
+            names.add(name[:-2])
+        elif name.endswith("S"):
+            names.add(name[:-1])
+    return names
+
+def relationship_candidates(metadata):
+    """
+    Name and type matched (child table, fk column, parent table, pk column).
+    A parent key is a column named ID, <ENTITY>_ID, <ENTITY>ID or
+    <ENTITY>_KEY of a table named after ENTITY; any other table with a
+    same-family column named like the reference is a candidate child.
+    """
+    references = {}     # referencing column name -> [(parent, pk, family)]
+    for table, cols in metadata.items():
+        names = entity_names(table)
+        by_name = {c["column"].upper(): c for c in cols}
+        for name in names:
+            for ref in (f"{name}_ID", f"{name}ID", f"{name}_KEY"):
+                pk = by_name.get(ref) or (by_name.get("ID") if not ref.endswith("_KEY") else None)
+                if pk:
+                    references.setdefault(ref, []).append(
+                        (table, pk["column"], type_family(pk["type"]))
+                    )
+
+    candidates = set()
+    for table, cols in metadata.items():
+        for c in cols:
+            for parent, pk, family in references.get(c["column"].upper(), []):
+                if parent != table and family == type_family(c["type"]):
+                    candidates.add((table, c["column"], parent, pk))
+    return sorted(candidates)
+
+def containment_lower_bound(found, read, z=1.96):
+    """Lower end of the 95% Wilson interval for found / read"""
+    if not read:
+        return 0.0
+    p = found / read
+    centre = p + z * z / (2 * read)
+    spread = z * math.sqrt(p * (1 - p) / read + z * z / (4 * read * read))
+    return (centre - spread) / (1 + z * z / read)
+
+class RelationshipInferenceAgent:
+    """
+    Deterministic foreign key inference. Candidates come from names and
+    types. Counts and APPROX_COUNT_DISTINCT per key column come from one
+    aggregate query per table, on at most RELATIONSHIP_SAMPLE_ROWS rows
+    for child-only columns and on the SAMPLE SYSTEM of parents above
+    APPROX_ROW_THRESHOLD. Each candidate is then confirmed by looking up
+    up to RELATIONSHIP_KEY_SAMPLE of the child's sampled distinct keys in
+    the parent key column (inclusion dependency).
+    """
+
+    def __init__(self, session):
+        self.session = session
+
+    def run(self, metadata, table_stats=None):
+        candidates = relationship_candidates(metadata)
+        if not candidates:
+            return {"relationships": []}
+
+        parents, children = {}, {}
+        for child, fk, parent, pk in candidates:
+            parents.setdefault(parent, set()).add(pk)
+            children.setdefault(child, set()).add(fk)
+
+        row_count = lambda t: (table_stats or {}).get(t, {}).get("row_count")
+        jobs = [(t, sorted(cols), False) for t, cols in parents.items()]
+        jobs += [
+            (t, sorted(cols - parents.get(t, set())), True)
+            for t, cols in children.items() if cols - parents.get(t, set())
+        ]
+        results = run_concurrently(
+            lambda job: self._sketch(*job, row_count(job[0])),
+            jobs, RELATIONSHIP_MAX_CONCURRENCY
+        )
+
+        sketches = {}
+        for (table, _, _), sketch in zip(jobs, results):
+            for column, stats in sketch.items():
+                sketches[(table, column)] = stats
+
+        checked = [
+            c for c in candidates
+            if (sketches.get((c[0], c[1])) or {}).get("distinct")
+            and (sketches.get((c[2], c[3])) or {}).get("distinct")
+        ]
+        inclusions = run_concurrently(
+            lambda c: self._inclusion(*c, row_count(c[0])), checked, RELATIONSHIP_MAX_CONCURRENCY
+        )
+
+        relationships = []
+        for (child, fk, parent, pk), inclusion in zip(checked, inclusions):
+            found = self._confirm(sketches[(child, fk)], sketches[(parent, pk)], inclusion)
+            if found:
+                relationships.append({
+                    "table1": child,
+                    "table2": parent,
+                    "relationship": fk if fk == pk else f"{fk} = {pk}",
+                    "from_column": fk,
+                    "to_column": pk,
+                    "source": "inferred",
+                    **found
+                })
+
+        # Keep the best parent per foreign key column
+        best = {}
+        for rel in relationships:
+            key = (rel["table1"], rel["from_column"])
+            if key not in best or rel["confidence"] > best[key]["confidence"]:
+                best[key] = rel
+        return {"relationships": sorted(best.values(), key=lambda r: -r["confidence"])}
+
+    def _sketch(self, table, columns, child_only, row_count):
+        """{column: {count, distinct}} from one aggregate statement"""
+        exprs = ["COUNT(*) AS ROWS_READ"]
+        for i, column in enumerate(columns):
+            exprs += [f"COUNT({column}) AS N{i}", f"APPROX_COUNT_DISTINCT({column}) AS D{i}"]
+
+        sample = ""
+        if child_only and (row_count is None or row_count > RELATIONSHIP_SAMPLE_ROWS):
+            sample = f" SAMPLE ({RELATIONSHIP_SAMPLE_ROWS} ROWS)"
+        elif sample_percent(row_count) is not None:
+            sample = f" SAMPLE SYSTEM ({sample_percent(row_count)})"
+
+        try:
+            row = self.session.sql(
+                f"SELECT {', '.join(exprs)} FROM {table}{sample}"
+            ).collect(statement_params=statement_params())[0]
+        except Exception as e:
+            print(f"   ⚠️  Relationship sketch failed for {table}: {str(e)}")
+            return {}
+
+        return {
+            column: {"count": row[f"N{i}"], "distinct": row[f"D{i}"]}
+            for i, column in enumerate(columns)
+        }
+
+    def _inclusion(self, child, fk, parent, pk, child_rows):
+        """
+        {read, found, complete}: how many of the child's sampled distinct
+        keys exist in the parent. `complete` is True when every distinct
+        child key was read, so found / read is exact.
+        """
+        sampled = child_rows is None or child_rows > RELATIONSHIP_SAMPLE_ROWS
+        sample = f" SAMPLE ({RELATIONSHIP_SAMPLE_ROWS} ROWS)" if sampled else ""
+        try:
+            row = self.session.sql(f"""
+                WITH CHILD_KEYS AS (
+                    SELECT K
+                    FROM (SELECT DISTINCT {fk} AS K FROM {child}{sample} WHERE {fk} IS NOT NULL)
+                    ORDER BY HASH(K)
+                    LIMIT {RELATIONSHIP_KEY_SAMPLE + 1}
+                )
+                SELECT
+                    (SELECT COUNT(*) FROM CHILD_KEYS) AS KEYS_READ,
+                    (SELECT COUNT(*) FROM CHILD_KEYS WHERE K IN (SELECT {pk} FROM {parent})) AS KEYS_FOUND
+            """).collect(statement_params=statement_params())[0]
+        except Exception as e:
+            print(f"   ⚠️  Key inclusion check failed for {child}.{fk} -> {parent}.{pk}: {str(e)}")
+            return None
+
+        read, found = row["KEYS_READ"] or 0, row["KEYS_FOUND"] or 0
+        return {"read": read, "found": found, "complete": not sampled and read <= RELATIONSHIP_KEY_SAMPLE}
+
+    def _confirm(self, child, parent, inclusion):
+        if not inclusion or not inclusion["read"]:
+            return None
+
+        # Exact when every child key was checked; otherwise the whole
+        # 95% interval of the sampled containment must clear the bar
+        containment = inclusion["found"] / inclusion["read"]
+        bound = containment if inclusion["complete"] else containment_lower_bound(
+            inclusion["found"], inclusion["read"]
+        )
+        if bound < RELATIONSHIP_MIN_CONTAINMENT:
+            return None
+
+        # Unique unless the HLL estimate falls below its 95% error band
+        unique = 1 - 1.96 * HLL_RELATIVE_ERROR
+        parent_unique = parent["distinct"] >= unique * parent["count"]
+        child_unique = child["distinct"] >= unique * child["count"]
+        return {
+            "cardinality": ("one_to_one" if child_unique else "many_to_one") if parent_unique else "many_to_many",
+            "confidence": round(containment * (1.0 if parent_unique else 0.7), 2)
+        }
+
+def merge_relationships(inferred, suggested):
+    """Inferred relationships plus Cortex suggestions for table pairs not yet covered"""
+    pairs = {frozenset((r["table1"], r["table2"])) for r in inferred}
+    merged = list(inferred)
+    for r in suggested:
+        if isinstance(r, dict) and frozenset((r.get("table1"), r.get("table2"))) not in pairs:
+            pairs.add(frozenset((r.get("table1"), r.get("table2"))))
+            merged.append({**r, "source": "cortex"})
+    return merged
+
+class KPIGeneratorAgent(SchemaAgent):
+    result_key = "kpis"
+    max_items = 4
+
+    def dedupe_key(self, item):
+        return sql_key(item.get("sql")).upper() or str(item.get("name", "")).lower()
+
+    def prompt(self, metadata):
+        return f"""
 Return STRICT JSON ONLY.
 
 Generate EXACTLY 4 KPIs.
@@ -326,36 +1595,516 @@ Rules:
 - Use real columns only
 
 Schema:
-{json.dumps(metadata)}
+{compact_schema(metadata)}
 
 Format:
 {{ "kpis": [{{ "name":"", "description":"", "sql":"" }}] }}
-""")
+"""
+
+# =========================================================
+# COLUMN STATISTICS
+# =========================================================
+
+COLUMN_STATS_TOP_K = int(os.getenv("COLUMN_STATS_TOP_K", "5"))
+CHART_MAX_DIMENSION_DISTINCT = int(os.getenv("CHART_MAX_DIMENSION_DISTINCT", "50"))
+MAX_NULL_FRACTION = float(os.getenv("MAX_NULL_FRACTION", "0.5"))
+
+SCALAR_TYPES = ("number", "text", "BOOLEAN", "DATE", "TIME") + TEMPORAL_TYPES
+KEY_COLUMN = re.compile(r"(^|_)(ID|KEY)$")
+
+class ColumnStatsCatalog:
+    """
+    Per-column statistics keyed by (schema scope, table) and stored with
+    the table's LAST_ALTERED version, in memory and in a local SQLite
+    file. Entries are valid until the table changes.
+    """
+
+    def __init__(self, path=None):
+        self._lock = threading.Lock()
+        self._memory = {}   # (scope, table) -> (version, stats)
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS COLUMN_STATS (
+                    SCOPE TEXT,
+                    TABLE_NAME TEXT,
+                    VERSION TEXT,
+                    STATS TEXT,
+                    PRIMARY KEY (SCOPE, TABLE_NAME)
+                )
+            """)
+            self._db.commit()
+
+    def get(self, scope, table, version):
+        version = str(version)
+        with self._lock:
+            entry = self._memory.get((scope, table))
+            if entry and entry[0] == version:
+                return entry[1]
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT VERSION, STATS FROM COLUMN_STATS WHERE SCOPE = ? AND TABLE_NAME = ?",
+                    (scope, table)
+                ).fetchone()
+                if row and row[0] == version:
+                    stats = json.loads(row[1])
+                    self._memory[(scope, table)] = (version, stats)
+                    return stats
+            return None
+
+    def put(self, scope, table, version, stats):
+        version = str(version)
+        with self._lock:
+            self._memory[(scope, table)] = (version, stats)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO COLUMN_STATS (SCOPE, TABLE_NAME, VERSION, STATS) VALUES (?, ?, ?, ?)",
+                    (scope, table, version, encode_json(stats).decode("utf-8"))
+                )
+                self._db.commit()
+
+COLUMN_STATS = ColumnStatsCatalog(
+    path=os.getenv(
+        "COLUMN_STATS_PATH",
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), ".column_stats.sqlite3")
+    )
+)
+
+class ColumnStatisticsAgent:
+    """
+    Null fraction, approximate distinct count, min / max and APPROX_TOP_K
+    for every column, in one aggregate statement per table (on a sample
+    for tables above APPROX_ROW_THRESHOLD). Results for base tables are
+    reused from COLUMN_STATS until LAST_ALTERED changes.
+    """
 
-class KPIExecutionAgent:
     def __init__(self, session):
         self.session = session
 
-    def run(self, defs):
-        results = []
+    def run(self, metadata, table_stats=None):
+        scope = "|".join(str(k) for k in schema_cache_key(self.session))
+        versions = table_versions(table_stats)
+        counts = row_counts(table_stats)
+
+        stats, missing = {}, []
+        for table in metadata:
+            version = versions.get(table)
+            cached = COLUMN_STATS.get(scope, table, version) if version is not None else None
+            if cached is not None:
+                stats[table] = cached
+            else:
+                missing.append(table)
+
+        computed = run_concurrently(
+            lambda t: self._table_stats(t, metadata[t], counts.get(t.upper())),
+            missing, PROFILE_MAX_CONCURRENCY
+        )
+        for table, table_stats_ in zip(missing, computed):
+            if table_stats_ is None:
+                continue
+            stats[table] = table_stats_
+            if versions.get(table) is not None:
+                COLUMN_STATS.put(scope, table, versions[table], table_stats_)
+
+        print(f"   ✅ [column_stats] {len(metadata) - len(missing)} cached / {len(missing)} computed table(s)")
+        return stats
+
+    def _table_stats(self, table, cols, row_count):
+        exprs = ["COUNT(*) AS ROWS_READ"]
+        for i, c in enumerate(cols):
+            column = c["column"]
+            exprs += [f"COUNT({column}) AS N{i}", f"APPROX_COUNT_DISTINCT({column}) AS D{i}"]
+            if type_family(c["type"]) in SCALAR_TYPES:
+                exprs += [
+                    f"MIN({column}) AS L{i}",
+                    f"MAX({column}) AS H{i}",
+                    f"APPROX_TOP_K({column}, {COLUMN_STATS_TOP_K}) AS K{i}"
+                ]
+        percent = sample_percent(row_count)
+        sample = f" SAMPLE SYSTEM ({percent})" if percent is not None else ""
+
+        try:
+            row = self.session.sql(
+                f"SELECT {', '.join(exprs)} FROM {table}{sample}"
+            ).collect(statement_params=statement_params())[0].as_dict()
+        except Exception as e:
+            print(f"   ⚠️  Column statistics failed for {table}: {str(e)}")
+            return None
+
+        rows = row["ROWS_READ"] or 0
+        return {
+            c["column"]: sanitize_for_json({
+                "null_fraction": round(1 - (row[f"N{i}"] or 0) / rows, 4) if rows else None,
+                "distinct": row[f"D{i}"],
+                "min": row.get(f"L{i}"),
+                "max": row.get(f"H{i}"),
+                "top_k": parse_variant(row.get(f"K{i}")) or [],
+                "sampled": percent is not None
+            })
+            for i, c in enumerate(cols)
+        }
+
+def well_populated(stats):
+    return stats is not None and (stats.get("null_fraction") or 0) <= MAX_NULL_FRACTION
+
+def choose_metric(cols, stats):
+    """Best non-key numeric column: mostly non-null and not constant"""
+    candidates = [
+        c for c in cols
+        if is_metric(c) and well_populated(stats.get(c["column"])) and (stats[c["column"]].get("distinct") or 0) > 1
+    ]
+    candidates.sort(key=lambda c: (stats[c["column"]]["null_fraction"] or 0, -(stats[c["column"]]["distinct"] or 0)))
+    return candidates[0]["column"] if candidates else None
+
+def choose_dimension(cols, stats):
+    """
+    (column, group expression) for a chart: a populated date column,
+    truncated to months when it has many distinct days, else the
+    populated non-key column with the fewest (at least 2) distinct values.
+    """
+    temporal, categorical = [], []
+    for c in cols:
+        column, st = c["column"], stats.get(c["column"])
+        if KEY_COLUMN.search(column.upper()) or not well_populated(st) or (st.get("distinct") or 0) < 2:
+            continue
+        if str(c["type"]).upper() in TEMPORAL_TYPES:
+            temporal.append((st["null_fraction"] or 0, column))
+        elif type_family(c["type"]) in ("text", "BOOLEAN") and st["distinct"] <= CHART_MAX_DIMENSION_DISTINCT:
+            categorical.append((st["distinct"], st["null_fraction"] or 0, column))
+
+    if temporal:
+        column = min(temporal)[1]
+        if stats[column]["distinct"] > CHART_MAX_DIMENSION_DISTINCT:
+            return column, f"DATE_TRUNC('MONTH', {column})"
+        return column, column
+    if categorical:
+        column = min(categorical)[2]
+        return column, column
+    return None, None
+
+def stats_chart_sql(table, dim, dim_expr, metric):
+    return f"""
+            SELECT {dim_expr} AS {dim}, SUM({metric}) AS VALUE
+            FROM {table}
+            GROUP BY {dim_expr}
+            ORDER BY {dim_expr}
+        """
+
+def fallback_kpi_defs(metadata, column_stats):
+    """One SUM KPI per table over its best-populated metric, from the column catalog"""
+    defs = []
+    for table, cols in metadata.items():
+        metric = choose_metric(cols, (column_stats or {}).get(table) or {})
+        if metric:
+            label = metric.replace("_", " ").title()
+            defs.append({
+                "name": f"{label if label.startswith('Total') else 'Total ' + label} ({table})",
+                "description": f"Sum of {metric} across {table}",
+                "sql": f"SELECT SUM({metric}) FROM {table}"
+            })
+    return defs
+
+# =========================================================
+# QUERY RESULT CACHE
+# =========================================================
+
+TABLE_REF_PATTERN = re.compile(
+    r'\b(?:FROM|JOIN)\s+((?:"[^"]+"|[\w$]+)(?:\s*\.\s*(?:"[^"]+"|[\w$]+))*)',
+    re.IGNORECASE
+)
+
+# A table reference followed by an optional alias and a comma (FROM A a, B b)
+COMMA_JOIN = re.compile(r"\s*(?:AS\s+)?(?:[\w$]+\s*)?,", re.IGNORECASE)
+
+def referenced_tables(sql):
+    """
+    Upper-cased names of the tables a statement reads FROM / JOINs, or
+    None when any reference cannot be tied to a table of the current
+    schema: qualified or case-sensitive names and comma-separated lists
+    """
+    tables = set()
+    for m in TABLE_REF_PATTERN.finditer(sql or ""):
+        ref = m.group(1)
+        if "." in ref or (ref.startswith('"') and ref.strip('"') != ref.strip('"').upper()):
+            return None
+        if COMMA_JOIN.match(sql, m.end()):
+            return None
+        tables.add(ref.strip('"').upper())
+    return tables
+
+def sql_key(sql):
+    return " ".join((sql or "").split())
+
+class QueryResultCache:
+    """
+    Size-bounded LRU of sanitized KPI / chart rows keyed by normalized
+    SQL plus the LAST_ALTERED version of every table it references.
+    Statements touching a table without a known version, or whose
+    references referenced_tables() cannot resolve, are not cached.
+    """
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def cache_key(scope, sql, table_versions):
+        tables = referenced_tables(sql)
+        versions = {t.upper(): v for t, v in (table_versions or {}).items()}
+        if not tables or any(versions.get(t) is None for t in tables):
+            return None
+        return (scope, sql_key(sql).rstrip(";"), tuple(sorted((t, str(versions[t])) for t in tables)))
+
+    def get(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, rows):
+        with self._lock:
+            self._entries[key] = rows
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+                "entries": len(self._entries)
+            }
+
+QUERY_RESULT_CACHE = QueryResultCache(
+    max_entries=int(os.getenv("QUERY_RESULT_CACHE_MAX_ENTRIES", "256"))
+)
+
+def cached_query(session, sql, table_versions, fetch):
+    """
+    Returns fetch(sql) (a sanitized row list), served from the result
+    cache when the referenced tables have not changed since it was stored.
+    """
+    key = QueryResultCache.cache_key(schema_cache_key(session), sql, table_versions)
+    if key is not None:
+        rows = QUERY_RESULT_CACHE.get(key)
+        if rows is not None:
+            return rows
+
+    rows = fetch(sql)
+    if key is not None:
+        QUERY_RESULT_CACHE.put(key, rows)
+    return rows
+
+SQL_MAX_CONCURRENCY = session_workers(int(os.getenv("SQL_MAX_CONCURRENCY", "4")))
+SQL_STATEMENT_TIMEOUT = int(os.getenv("SQL_STATEMENT_TIMEOUT", "120"))
+
+def statement_params():
+    """Per-statement settings for generated KPI / chart SQL"""
+    return {"STATEMENT_TIMEOUT_IN_SECONDS": SQL_STATEMENT_TIMEOUT}
+
+# =========================================================
+# GENERATED SQL GUARD
+# =========================================================
+
+# Generated KPI / chart SQL is EXPLAINed before it runs. Statements whose
+# plan exceeds either budget (0 disables) are rewritten onto a sample when
+# approximate_sql() supports them (SQL_GUARD_MODE=sample), else rejected.
+SQL_GUARD_MODE = os.getenv("SQL_GUARD_MODE", "sample").lower()   # off | reject | sample
+SQL_MAX_BYTES_SCANNED = int(os.getenv("SQL_MAX_BYTES_SCANNED", str(10 * 1024 ** 3)))
+SQL_MAX_PARTITIONS = int(os.getenv("SQL_MAX_PARTITIONS", "10000"))
+
+WRITE_KEYWORDS = re.compile(
+    r"\b(INSERT|UPDATE|DELETE|MERGE|CREATE|DROP|ALTER|TRUNCATE|GRANT|REVOKE|CALL|COPY|UNDROP|EXECUTE)\b"
+)
+SQL_LITERAL = re.compile(r"'(?:[^'\\]|\\.|'')*'|\"(?:[^\"]|\"\")*\"|--[^\n]*|//[^\n]*|/\*.*?\*/", re.DOTALL)
+TRAILING_LIMIT = re.compile(r"LIMIT\s+(\d+)(\s+OFFSET\s+\d+)?\s*$", re.IGNORECASE)
+
+def mask_sql(sql):
+    """sql with literals, quoted identifiers and comments blanked out (same length)"""
+    return SQL_LITERAL.sub(lambda m: " " * len(m.group(0)), sql)
+
+def top_level_matches(pattern, sql):
+    """Matches of pattern in sql that sit outside parentheses, literals and comments"""
+    masked = mask_sql(sql).upper()
+    depth_at, depth = [], 0
+    for ch in masked:
+        depth_at.append(depth)
+        depth += {"(": 1, ")": -1}.get(ch, 0)
+    return [m for m in re.finditer(pattern, masked) if depth_at[m.start()] == 0]
+
+def validate_read_only(sql):
+    """Raises ValueError unless sql is a single SELECT / WITH statement"""
+    masked = mask_sql(sql or "").strip().rstrip(";").upper()
+    if not re.match(r"(SELECT|WITH)\b", masked):
+        raise ValueError("Only SELECT / WITH statements may run")
+    if ";" in masked:
+        raise ValueError("Multiple statements are not allowed")
+    if WRITE_KEYWORDS.search(masked):
+        raise ValueError("Statement contains a write / DDL keyword")
+
+def strip_trailing_sql(sql):
+    """sql without trailing whitespace, semicolons and comments"""
+    sql = sql.strip().rstrip(";").rstrip()
+    while True:
+        last = None
+        for last in SQL_LITERAL.finditer(sql):
+            pass
+        if last is None or not last.group(0).startswith(("--", "//", "/*")) or sql[last.end():].strip():
+            return sql
+        sql = sql[:last.start()].strip().rstrip(";").rstrip()
+
+def cap_rows(sql, cap):
+    """
+    Caps the rows sql returns at `cap`: an existing top-level LIMIT is
+    lowered when larger, a statement without one gets LIMIT appended, and
+    anything else (FETCH, TOP, non-literal LIMIT) is wrapped in a subquery.
+    Appended text starts on a new line, so a line comment cannot hide it.
+    """
+    sql = strip_trailing_sql(sql)
+    limits = top_level_matches(r"\bLIMIT\b", sql)
+    if not limits and not top_level_matches(r"\b(FETCH|TOP)\b", sql):
+        return f"{sql}\nLIMIT {cap}"
+    if len(limits) == 1:
+        m = TRAILING_LIMIT.match(sql, limits[0].start())
+        if m:
+            if int(m.group(1)) <= cap:
+                return sql
+            return f"{sql[:m.start(1)]}{cap}{sql[m.end(1):]}"
+    return f"SELECT * FROM (\n{sql}\n) LIMIT {cap}"
+
+def explain_cost(session, sql, table_versions):
+    """{"bytes": ..., "partitions": ...} from the compiled plan; no warehouse time"""
+    def fetch(explain_sql):
+        rows = session.sql(explain_sql).collect()
+        stats = parse_variant(rows[0][0]).get("GlobalStats", {}) if rows else {}
+        return [{
+            "bytes": stats.get("bytesAssigned") or 0,
+            "partitions": stats.get("partitionsAssigned") or 0
+        }]
+    return cached_query(session, f"EXPLAIN USING JSON {sql}", table_versions, fetch)[0]
+
+def guard_sql(session, sql, table_versions=None, row_counts=None, row_cap=None):
+    """
+    Checks one generated statement before it runs: read-only validation,
+    approximate mode for huge tables, the EXPLAIN budgets and a row cap.
+    Returns (sql to run, approximation details or None); raises ValueError
+    when the statement must not run.
+    """
+    validate_read_only(sql)
+    original = sql
+    sql, approximate = approximate_sql(sql, row_counts)
+
+    if SQL_GUARD_MODE != "off" and (SQL_MAX_BYTES_SCANNED or SQL_MAX_PARTITIONS):
+        # EXPLAIN does not reflect SAMPLE SYSTEM, so the exact statement's
+        # plan is scaled by the fraction of blocks a sample reads
+        cost = explain_cost(session, original, table_versions)
+        percent = approximate["sample_percent"] if approximate else 100.0
+        ratios = [
+            cost[key] * percent / 100 / budget
+            for key, budget in (("bytes", SQL_MAX_BYTES_SCANNED), ("partitions", SQL_MAX_PARTITIONS))
+            if budget
+        ]
+        if max(ratios) > 1:
+            over = f"{cost['bytes']:,} bytes / {cost['partitions']:,} partitions"
+            if approximate:
+                over += f" at {percent}%"
+            if SQL_GUARD_MODE != "sample":
+                raise ValueError(f"Statement exceeds the scan budget ({over})")
+
+            percent = math.floor(percent / max(ratios) * 1e6) / 1e6
+            approximate = None
+            if percent > 0:
+                sql, approximate = approximate_sql(original, row_counts, percent=percent)
+            if approximate is None:
+                raise ValueError(f"Statement exceeds the scan budget and cannot be sampled to fit it ({over})")
+            print(f"   ⚠️  Sampling statement over the scan budget ({over}) at {percent}%")
+
+    if row_cap:
+        sql = cap_rows(sql, row_cap)
+        if approximate:
+            approximate = {**approximate, "sql": sql}
+    return sql, approximate
+
+class KPIExecutionAgent:
+    def __init__(self, session, table_versions=None, row_counts=None):
+        self.session = session
+        self.table_versions = table_versions
+        self.row_counts = row_counts
+
+    def run(self, defs, reuse=None, fallback=None):
+        """
+        Executes the generated KPI statements concurrently
+        (SQL_MAX_CONCURRENCY) with a per-statement timeout, then tops
+        up to 4 KPIs from the fallback definitions. `fallback` may be a
+        callable, invoked only when a top-up is needed.
+        """
+
+        def execute(k):
+            previous = reuse(k) if reuse else None
+            if previous is not None:
+                return previous
 
-        for k in defs.get("kpis", [])[:4]:
             try:
-                val = self.session.sql(k["sql"]).collect()[0][0]
-                results.append({
+                sql, approximate = guard_sql(
+                    self.session, k["sql"], self.table_versions, self.row_counts, row_cap=1
+                )
+                rows = cached_query(self.session, sql, self.table_versions, self._fetch)
+                val = next(iter(rows[0].values()))
+                kpi = {
                     "name": k["name"],
                     "description": k["description"],
                     "sql": k["sql"],
                     "value": sanitize_for_json(val)
-                })
+                }
+                if approximate:
+                    kpi["approximate"] = approximate
+                return kpi
+            except ValueError as e:
+                print(f"   ⚠️  KPI '{k.get('name')}' not run: {str(e)}")
+                return None
             except Exception:
-                continue
+                return None
 
-        return results
+        results = run_concurrently(execute, defs.get("kpis", [])[:4], SQL_MAX_CONCURRENCY)
+        kpis = [r for r in results if r is not None]
 
-class ChartGeneratorAgent(BaseAgent):
-    def run(self, metadata):
-        return self.cortex(f"""
+        if len(kpis) >= 4 or not fallback:
+            return kpis
+
+        seen = {sql_key(k["sql"]).upper() for k in kpis}
+        candidates = [
+            k for k in (fallback() if callable(fallback) else fallback)
+            if sql_key(k["sql"]).upper() not in seen
+        ]
+        while len(kpis) < 4 and candidates:
+            batch, candidates = candidates[:4 - len(kpis)], candidates[4 - len(kpis):]
+            kpis.extend(r for r in run_concurrently(execute, batch, SQL_MAX_CONCURRENCY) if r is not None)
+
+        return kpis
+
+    def _fetch(self, sql):
+        rows = self.session.sql(sql).collect(statement_params=statement_params())
+        return sanitize_for_json([r.as_dict() for r in rows])
+
+class ChartGeneratorAgent(SchemaAgent):
+    result_key = "charts"
+    max_items = 4
+
+    def dedupe_key(self, item):
+        return sql_key(item.get("sql")).upper() or str(item.get("name", "")).lower()
+
+    def prompt(self, metadata):
+        return f"""
 Return STRICT JSON ONLY.
 
 Generate EXACTLY 4 charts.
@@ -376,115 +2125,322 @@ Each chart MUST include:
 - y_axis
 
 Schema:
-{json.dumps(metadata)}
+{compact_schema(metadata)}
 
 Format:
 {{ "charts": [{{}}] }}
-""")
+"""
+
+def fallback_chart_def(table, cols, stats=None):
+    """
+    Dynamic trend chart for a table: the catalog's best dimension and
+    metric when column statistics are available, else the first
+    date-like column vs the first numeric column.
+    """
+    if stats:
+        dim, dim_expr = choose_dimension(cols, stats)
+        metric = choose_metric(cols, stats)
+        if not dim or not metric:
+            return None
+        return {
+            "name": f"{table} Trend",
+            "description": f"{metric} aggregated by {dim}",
+            "chart_type": "line",
+            "x_axis": dim,
+            "y_axis": "VALUE",
+            "sql": stats_chart_sql(table, dim, dim_expr, metric)
+        }
+
+    dim_cols = [
+        c["column"] for c in cols
+        if any(x in c["column"].upper() for x in ["DATE", "DAY", "MONTH"])
+    ]
+    metric_cols = [
+        c["column"] for c in cols
+        if any(x in c["type"].upper() for x in ["NUMBER", "INT", "FLOAT"])
+    ]
+
+    if not dim_cols or not metric_cols:
+        return None
+
+    dim = dim_cols[0]
+    metric = metric_cols[0]
+
+    return {
+        "name": f"{table} Trend",
+        "description": f"{metric} aggregated by {dim}",
+        "chart_type": "line",
+        "x_axis": dim,
+        "y_axis": "VALUE",
+        "sql": f"""
+            SELECT {dim}, SUM({metric}) AS VALUE
+            FROM {table}
+            GROUP BY {dim}
+            ORDER BY {dim}
+        """
+    }
+
+CHART_SAMPLE_ROWS = int(os.getenv("CHART_SAMPLE_ROWS", "20"))
+
+def arrow_to_columnar(table):
+    """
+    Converts an Arrow table column by column: nulls become 0 (as the old
+    fillna(0) did), decimals become floats and temporal values ISO strings.
+    Returns {"columns": [...], "data": [[...], ...]}.
+    """
+    values = []
+    for col in table.columns:
+        if pa.types.is_decimal(col.type):
+            col = pc.cast(col, pa.float64())
+        elif pa.types.is_date(col.type) or pa.types.is_time(col.type):
+            col = pc.cast(col, pa.string())
+        elif pa.types.is_timestamp(col.type):
+            values.append([0 if v is None else v.isoformat() for v in col.to_pylist()])
+            continue
+
+        if pa.types.is_integer(col.type) or pa.types.is_floating(col.type):
+            values.append(pc.fill_null(col, 0).to_pylist())
+        else:
+            vals = col.to_pylist()
+            values.append([0 if v is None else v for v in vals] if col.null_count else vals)
+
+    return {"columns": table.column_names, "data": [list(row) for row in zip(*values)]}
+
+def shape_sample_data(sample, sample_format):
+    """Returns chart rows as records or as {"columns", "data"}, from either shape"""
+    if isinstance(sample, dict):
+        if sample_format == "columnar":
+            return sample
+        return [dict(zip(sample["columns"], row)) for row in sample["data"]]
+
+    if sample_format != "columnar":
+        return sample
+    columns = list(sample[0]) if sample else []
+    return {"columns": columns, "data": [[r.get(c) for c in columns] for r in sample]}
 
 class ChartDataAgent:
-    def __init__(self, session):
+    def __init__(self, session, table_versions=None, sample_format="records", row_counts=None):
         self.session = session
+        self.table_versions = table_versions
+        self.sample_format = sample_format
+        self.row_counts = row_counts
 
-    def run(self, defs, metadata):
-        charts = []
+    def _sample_data(self, sql):
+        sample = cached_query(self.session, sql, self.table_versions, self._fetch)
+        return shape_sample_data(sample, self.sample_format)
 
-        # -----------------------------
-        # PASS 1: Cortex-generated charts
-        # -----------------------------
-        for c in defs.get("charts", [])[:4]:
-            try:
-                sql = c.get("sql")
+    def _with_sample(self, chart):
+        """
+        chart plus its first CHART_SAMPLE_ROWS rows, after guard_sql()
+        (read approximately on huge tables or over the scan budget)
+        """
+        try:
+            sql, approximate = guard_sql(
+                self.session, chart["sql"], self.table_versions, self.row_counts,
+                row_cap=CHART_SAMPLE_ROWS
+            )
+        except ValueError as e:
+            print(f"   ⚠️  Chart '{chart.get('name')}' not run: {str(e)}")
+            raise
+        result = {**chart, "sample_data": self._sample_data(sql)}
+        if approximate:
+            result["approximate"] = approximate
+        return result
 
-                # Auto-repair if SQL missing or invalid
-                if not sql:
-                    repaired = repair_chart_sql(c, metadata)
-                    if not repaired:
-                        continue
-                    c = repaired
-
-                df = self.session.sql(c["sql"] + " LIMIT 20").to_pandas()
-                df = df.fillna(0)
-
-                charts.append({
-                    "name": c["name"],
-                    "description": c["description"],
-                    "chart_type": c["chart_type"],
-                    "x_axis": c["x_axis"],
-                    "y_axis": c["y_axis"],
-                    "sql": c["sql"],
-                    "sample_data": sanitize_for_json(
-                        df.to_dict(orient="records")
-                    )
-                })
+    def _fetch(self, sql):
+        """Fetches through the connector cursor, using Arrow batches when available"""
+        cur = self.session.connection.cursor()
+        try:
+            cur.execute(sql, timeout=SQL_STATEMENT_TIMEOUT)
+            columns = [d[0] for d in cur.description]
 
-            except Exception:
-                # Last-resort repair
-                repaired = repair_chart_sql(c, metadata)
-                if repaired:
-                    try:
-                        df = self.session.sql(repaired["sql"] + " LIMIT 20").to_pandas()
-                        charts.append({
-                            **repaired,
-                            "sample_data": sanitize_for_json(
-                                df.fillna(0).to_dict(orient="records")
-                            )
-                        })
-                    except Exception:
-                        continue
+            if pa is not None:
+                try:
+                    batches = list(cur.fetch_arrow_batches())
+                except Exception:
+                    batches = None  # result not in Arrow format; read rows instead
+                if batches is not None:
+                    if not batches:
+                        return {"columns": columns, "data": []}
+                    return arrow_to_columnar(pa.concat_tables(batches))
 
-        # -----------------------------
-        # PASS 2: GUARANTEED FALLBACK (Dynamic)
-        # -----------------------------
-        if len(charts) < 4:
-            for table, cols in metadata.items():
-                dim_cols = [
-                    c["column"] for c in cols
-                    if any(x in c["column"].upper() for x in ["DATE", "DAY", "MONTH"])
-                ]
-                metric_cols = [
-                    c["column"] for c in cols
-                    if any(x in c["type"].upper() for x in ["NUMBER", "INT", "FLOAT"])
-                ]
+            rows = cur.fetchall()
+            return {
+                "columns": columns,
+                "data": sanitize_for_json([[0 if v is None else v for v in row] for row in rows])
+            }
+        finally:
+            cur.close()
 
-                if not dim_cols or not metric_cols:
-                    continue
+    def _cortex_chart(self, c, metadata, reuse, column_stats):
+        previous = reuse(c) if reuse else None
+        if previous is not None:
+            return {**previous, "sample_data": shape_sample_data(previous["sample_data"], self.sample_format)}
 
-                dim = dim_cols[0]
-                metric = metric_cols[0]
+        try:
+            sql = c.get("sql")
+
+            # Auto-repair if SQL missing or invalid
+            if not sql:
+                repaired = repair_chart_sql(c, metadata, column_stats())
+                if not repaired:
+                    return None
+                c = repaired
+
+            return self._with_sample({
+                "name": c["name"],
+                "description": c["description"],
+                "chart_type": c["chart_type"],
+                "x_axis": c["x_axis"],
+                "y_axis": c["y_axis"],
+                "sql": c["sql"]
+            })
 
+        except Exception:
+            # Last-resort repair
+            repaired = repair_chart_sql(c, metadata, column_stats())
+            if repaired:
                 try:
-                    sql = f"""
-                        SELECT {dim}, SUM({metric}) AS VALUE
-                        FROM {table}
-                        GROUP BY {dim}
-                        ORDER BY {dim}
-                    """
-
-                    df = self.session.sql(sql + " LIMIT 20").to_pandas()
-                    df = df.fillna(0)
-
-                    charts.append({
-                        "name": f"{table} Trend",
-                        "description": f"{metric} aggregated by {dim}",
-                        "chart_type": "line",
-                        "x_axis": dim,
-                        "y_axis": "VALUE",
-                        "sql": sql,
-                        "sample_data": sanitize_for_json(
-                            df.to_dict(orient="records")
-                        )
-                    })
+                    return self._with_sample(repaired)
                 except Exception:
-                    continue
+                    return None
+            return None
 
-                if len(charts) >= 4:
-                    break
+    def _fallback_chart(self, chart, reuse):
+        previous = reuse(chart) if reuse else None
+        if previous is not None:
+            return {**previous, "sample_data": shape_sample_data(previous["sample_data"], self.sample_format)}
+
+        try:
+            return self._with_sample(chart)
+        except Exception:
+            return None
+
+    def run(self, defs, metadata, reuse=None, column_stats=None):
+        """
+        Chart queries run concurrently (SQL_MAX_CONCURRENCY) with a
+        per-statement timeout; results keep the definition order.
+        column_stats (ColumnStatisticsAgent output, or a callable
+        returning it, invoked only when a chart needs repair or fallback)
+        drives repaired and fallback charts towards low-cardinality
+        dimensions.
+        """
+        if not callable(column_stats):
+            stats = column_stats or {}
+            column_stats = lambda: stats
+
+        # -----------------------------
+        # PASS 1: Cortex-generated charts
+        # -----------------------------
+        charts = [
+            c for c in run_concurrently(
+                lambda c: self._cortex_chart(c, metadata, reuse, column_stats),
+                defs.get("charts", [])[:4],
+                SQL_MAX_CONCURRENCY
+            )
+            if c is not None
+        ]
+
+        # -----------------------------
+        # PASS 2: GUARANTEED FALLBACK (Dynamic)
+        # -----------------------------
+        if len(charts) >= 4:
+            return charts[:4]
+
+        stats = column_stats()
+        candidates = [
+            chart for chart in (fallback_chart_def(t, cols, stats.get(t)) for t, cols in metadata.items())
+            if chart
+        ]
+        while len(charts) < 4 and candidates:
+            batch, candidates = candidates[:4 - len(charts)], candidates[4 - len(charts):]
+            charts.extend(
+                c for c in run_concurrently(
+                    lambda c: self._fallback_chart(c, reuse), batch, SQL_MAX_CONCURRENCY
+                )
+                if c is not None
+            )
 
         return charts[:4]
-   
+
+SIGNALS_LEGEND = (
+    "One table per line as TABLE: column check=count. "
+    "~ marks approximate counts, followed by their 95% margin when known; "
+    "an approximate count of 0 means nothing significant within that margin."
+)
+
+def compact_signals(signals):
+    """Token-lean rendering of DQ signals for prompts, one line per table"""
+    by_table = {}
+    for s in signals:
+        entry = f"{s.get('column')} {s.get('signal')}={s.get('count')}"
+        if s.get("approximate"):
+            entry += "~" + (f"±{s['error']}" if s.get("error") is not None else "")
+        by_table.setdefault(s.get("table"), []).append(entry)
+    return "\n".join(f"{t}: " + ", ".join(entries) for t, entries in by_table.items())
+
+def fit_signals(signals, token_budget):
+    """The largest-count signals whose compact rendering fits token_budget"""
+    kept, used = [], estimate_tokens(SIGNALS_LEGEND)
+    for s in sorted(signals, key=lambda s: -(s.get("count") or 0)):
+        cost = estimate_tokens(compact_signals([s]))
+        if used + cost > token_budget:
+            break
+        kept.append(s)
+        used += cost
+    return kept
+
 class DataQualityAgent(BaseAgent):
     def run(self, metadata, signals):
+        """
+        Wide schemas are assessed shard by shard (each with its own
+        tables' signals, counted against the token budget); issues are
+        concatenated and the overall score is averaged, weighted by the
+        tables in each shard.
+        """
+        by_table = {}
+        for s in signals:
+            by_table.setdefault(s.get("table"), []).append(s)
+        shards = shard_schema(
+            metadata, SCHEMA_PROMPT_TOKEN_BUDGET,
+            extra_cost=lambda t: estimate_tokens(compact_signals(by_table.get(t, [])))
+        )
+        if len(shards) == 1:
+            return self._assess(metadata, signals)
+
+        results = run_concurrently(
+            lambda shard: self._assess(shard, [s for s in signals if s.get("table") in shard]),
+            shards, SCHEMA_SHARD_CONCURRENCY
+        )
+
+        issues, seen, weighted, weight = [], set(), 0.0, 0
+        for shard, result in zip(shards, results):
+            for issue in result.get("issues", []):
+                key = (issue.get("table"), issue.get("column"), issue.get("issue"))
+                if key not in seen:
+                    seen.add(key)
+                    issues.append(issue)
+            try:
+                weighted += float(result.get("overall_score")) * len(shard)
+                weight += len(shard)
+            except (TypeError, ValueError):
+                pass
+
+        return {
+            "overall_score": round(weighted / weight) if weight else None,
+            "issues": issues
+        }
+
+    def _assess(self, metadata, signals):
+        # A table too wide for one shard still leaves its signals a quarter of the budget
+        schema = compact_schema(metadata)
+        budget = max(SCHEMA_PROMPT_TOKEN_BUDGET - estimate_tokens(schema), SCHEMA_PROMPT_TOKEN_BUDGET // 4)
+        kept = fit_signals(signals, budget)
+        omitted = ""
+        if len(kept) < len(signals):
+            print(f"   ℹ️  {len(signals) - len(kept)} smaller data quality signal(s) left out of the prompt")
+            omitted = f"\n({len(signals) - len(kept)} signals with smaller counts omitted)"
+
         return self.cortex(f"""
 Return STRICT JSON ONLY.
 
@@ -499,10 +2455,11 @@ Issue types allowed:
 - Invalid dates
 
 Signals (from SQL execution):
-{json.dumps(signals)}
+{SIGNALS_LEGEND}
+{compact_signals(kept)}{omitted}
 
 Metadata:
-{json.dumps(metadata)}
+{schema}
 
 Output format:
 {{
@@ -556,12 +2513,14 @@ Format:
 
         return result
 
-def normalize(load_id, metadata, profile, relationships, kpis, charts, quality, insights):
-    return {
+def normalize(load_id, metadata, profile, relationships, kpis, charts, quality, insights,
+              signals=None, database=None, schema=None, incremental=None):
+    report = {
         "meta": {
             "load_id": load_id,
             "generated_at": datetime.utcnow().isoformat(),
-            "schema_analyzed": os.getenv("SNOWFLAKE_SCHEMA")
+            "database_analyzed": database or os.getenv("SNOWFLAKE_DATABASE"),
+            "schema_analyzed": schema or os.getenv("SNOWFLAKE_SCHEMA")
         },
         "summary": {
             "tables_count": len(metadata),
@@ -575,14 +2534,15 @@ def normalize(load_id, metadata, profile, relationships, kpis, charts, quality,
                 {
                     "table": t,
                     "columns": len(metadata[t]),
-                    "rows": profile.get(t, {}).get("row_count")
+                    "rows": profile.get(t, {}).get("row_count"),
+                    "last_altered": profile.get(t, {}).get("last_altered")
                 } for t in metadata
             ],
             "relationships": relationships.get("relationships", [])
         },
         "kpis": kpis,
         "charts": charts,
-        "data_quality": quality,
+        "data_quality": {**quality, "signals": signals or []},
         "transformations": [
             {
                 "table": i["table"],
@@ -593,30 +2553,435 @@ def normalize(load_id, metadata, profile, relationships, kpis, charts, quality,
         ],
         "insights": insights
     }
+    if incremental:
+        report["incremental"] = incremental
+
+    approximations = (
+        [{"section": "kpis", "name": k["name"], **k["approximate"]} for k in kpis if k.get("approximate")]
+        + [{"section": "charts", "name": c["name"], **c["approximate"]} for c in charts if c.get("approximate")]
+        + [
+            {
+                "section": "data_quality", "table": s["table"], "column": s["column"],
+                "signal": s["signal"], "method": s["method"], "error": s["error"]
+            }
+            for s in (signals or []) if isinstance(s, dict) and s.get("approximate")
+        ]
+    )
+    if approximations:
+        report["approximations"] = approximations
+    return report
+
+# =========================================================
+# REPORT CACHE
+# =========================================================
+
+class ReportCache:
+    """
+    Byte-budgeted LRU of encoded reports keyed by load_id, plus a pointer
+    to the latest load_id in the .env report store. Stored reports never
+    change, so entries are only ever evicted, not invalidated. The latest
+    pointer is set when a report is stored and trusted for `latest_ttl`
+    seconds, bounding staleness when other processes write reports.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, latest_ttl=60):
+        self.max_bytes = max_bytes
+        self.latest_ttl = latest_ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()   # load_id -> (load_datetime, payload)
+        self._bytes = 0
+        self._latest = None             # (load_id, set_at)
+        self._latest_listeners = []
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, load_id):
+        with self._lock:
+            entry = self._entries.get(load_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(load_id)
+            self.hits += 1
+            return entry
+
+    def put(self, load_id, load_datetime, payload):
+        if len(payload) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(load_id, None)
+            if old:
+                self._bytes -= len(old[1])
+            self._entries[load_id] = (load_datetime, payload)
+            self._bytes += len(payload)
+            while self._bytes > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._bytes -= len(evicted)
+
+    def latest(self):
+        """The latest load_id, or None when unknown or older than latest_ttl"""
+        with self._lock:
+            if self._latest and time.time() - self._latest[1] < self.latest_ttl:
+                return self._latest[0]
+            return None
+
+    def set_latest(self, load_id):
+        with self._lock:
+            changed = not self._latest or self._latest[0] != load_id
+            self._latest = (load_id, time.time())
+            listeners = list(self._latest_listeners) if changed else []
+        for listener in listeners:
+            listener(load_id)
+
+    def on_new_latest(self, listener):
+        """Calls listener(load_id) whenever a different load becomes the latest"""
+        with self._lock:
+            self._latest_listeners.append(listener)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "latest": self._latest[0] if self._latest else None
+            }
+
+REPORT_CACHE = ReportCache(
+    max_bytes=int(os.getenv("REPORT_CACHE_MAX_BYTES", str(64 * 1024 * 1024))),
+    latest_ttl=int(os.getenv("REPORT_LATEST_TTL", "60"))
+)
+
+def report_etag(load_id):
+    """Strong ETag; a stored report's content is fixed by its load_id"""
+    return f"report-{load_id}"
+
+def is_env_report_store(session):
+    """True when session writes to the CLEAN_INSIGHTS_STORE read by /clean-report"""
+    env = (os.getenv("SNOWFLAKE_DATABASE"), os.getenv("SNOWFLAKE_SCHEMA"))
+    return all(env) and tuple(n.upper() for n in env) == tuple(
+        (n or "").upper() for n in session_names(session)
+    )
+
+def load_clean_report(load_id=None, session=None):
+    """
+    (load_id, load_datetime, payload) for load_id, or for the latest report
+    when load_id is None; None when no report exists. Served from
+    REPORT_CACHE when possible, otherwise read from the .env report store
+    (through `session` if given).
+    """
+    load_id = load_id or REPORT_CACHE.latest()
+    if load_id:
+        entry = REPORT_CACHE.get(load_id)
+        if entry:
+            return (load_id, *entry)
+
+    if session is None:
+        with pooled_env_session() as session:
+            return load_clean_report(load_id, session)
+
+    if load_id is None:
+        # Cheap lookup first; the latest report is often already cached
+        res = session.sql("""
+            SELECT LOAD_ID
+            FROM CLEAN_INSIGHTS_STORE
+            ORDER BY LOAD_DATETIME DESC, LOAD_ID DESC
+            LIMIT 1
+        """).collect()
+        if not res:
+            return None
+        load_id = res[0]["LOAD_ID"]
+        REPORT_CACHE.set_latest(load_id)
+        entry = REPORT_CACHE.get(load_id)
+        if entry:
+            return (load_id, *entry)
+
+    res = session.sql("""
+        SELECT LOAD_ID, LOAD_DATETIME, CLEAN_JSON
+        FROM CLEAN_INSIGHTS_STORE
+        WHERE LOAD_ID = %s
+        ORDER BY LOAD_DATETIME DESC
+        LIMIT 1
+    """, params=[load_id]).collect()
+    if not res:
+        return None
+
+    load_datetime = str(res[0]["LOAD_DATETIME"])
+    payload = encode_json(parse_variant(res[0]["CLEAN_JSON"]))
+    REPORT_CACHE.put(load_id, load_datetime, payload)
+    return load_id, load_datetime, payload
+
+def report_summary_values(report):
+    """
+    [tables_count, quality_score, schema] for the TABLES_COUNT,
+    QUALITY_SCORE and SCHEMA_NAME columns written next to CLEAN_JSON,
+    so /clean-report/runs never reads the VARIANT
+    """
+    summary = report.get("summary", {})
+    try:
+        quality_score = float(summary.get("quality_score"))
+    except (TypeError, ValueError):
+        quality_score = None
+    return [
+        summary.get("tables_count"),
+        quality_score,
+        report.get("meta", {}).get("schema_analyzed")
+    ]
+
+def store_clean_report(session, load_id, final_json, payload=None):
+    """payload: final_json already encoded by encode_json, if available"""
+    if payload is None:
+        payload = encode_json(final_json)
+
+    try:
+        session.sql("""
+            INSERT INTO CLEAN_INSIGHTS_STORE
+            (LOAD_ID, LOAD_DATETIME, CLEAN_JSON, TABLES_COUNT, QUALITY_SCORE, SCHEMA_NAME)
+            SELECT %s, CURRENT_TIMESTAMP(), PARSE_JSON(%s), %s, %s, %s
+        """, params=[
+            load_id,
+            payload.decode("utf-8"),
+            *report_summary_values(final_json)
+        ]).collect()
+    except Exception as e:
+        # Store not migrated yet (see README); the migration backfills these rows
+        print(f"   ⚠️  Storing without summary columns: {str(e)}")
+        session.sql("""
+            INSERT INTO CLEAN_INSIGHTS_STORE (LOAD_ID, LOAD_DATETIME, CLEAN_JSON)
+            SELECT %s, CURRENT_TIMESTAMP(), PARSE_JSON(%s)
+        """, params=[load_id, payload.decode("utf-8")]).collect()
+
+    if is_env_report_store(session):
+        REPORT_CACHE.set_latest(load_id)
+
+# =========================================================
+# INCREMENTAL RE-ANALYSIS
+# =========================================================
+
+class IncrementalPlan:
+    """
+    Compares each table's LAST_ALTERED and row count with the previous
+    report and hands back that report's profile, KPIs, charts and DQ
+    signals for tables that did not change. Records which sections
+    were reused and which were recomputed.
+    """
+
+    def __init__(self, previous, table_stats):
+        self.base_load_id = previous.get("meta", {}).get("load_id")
+
+        prev_tables = {
+            t["table"]: t for t in previous.get("understanding", {}).get("tables", [])
+        }
+        self.unchanged = set()
+        for table, stats in table_stats.items():
+            prev = prev_tables.get(table)
+            if (
+                prev
+                and stats.get("row_count") is not None
+                and stats.get("last_altered") is not None
+                and prev.get("rows") == stats["row_count"]
+                and prev.get("last_altered") == sanitize_for_json(stats["last_altered"])
+            ):
+                self.unchanged.add(table)
+        self.changed = set(table_stats) - self.unchanged
+        self._unchanged_upper = {t.upper() for t in self.unchanged}
+
+        self._kpis = {sql_key(k.get("sql")): k for k in previous.get("kpis", [])}
+        self._charts = {sql_key(c.get("sql")): c for c in previous.get("charts", [])}
+        dq = previous.get("data_quality") or {}
+        self._signals = dq.get("signals") if isinstance(dq, dict) else None
+
+        self.sections = {
+            name: {"reused": [], "recomputed": []}
+            for name in ("profile", "kpis", "charts", "data_quality")
+        }
+
+    def _is_unchanged(self, tables):
+        return bool(tables) and all(t.upper() in self._unchanged_upper for t in tables)
+
+    def _reuse(self, section, previous_by_sql, definition, label):
+        sql = definition.get("sql")
+        previous = previous_by_sql.get(sql_key(sql))
+        if previous is not None and self._is_unchanged(referenced_tables(sql)):
+            self.sections[section]["reused"].append(previous.get("name", label))
+            return previous
+        self.sections[section]["recomputed"].append(definition.get("name", label))
+        return None
+
+    def reuse_kpi(self, kpi_def):
+        return self._reuse("kpis", self._kpis, kpi_def, "KPI")
+
+    def reuse_chart(self, chart_def):
+        return self._reuse("charts", self._charts, chart_def, "Chart")
+
+    def split_profile(self, tables):
+        """Returns (tables to re-profile, tables whose metadata profile is reused)"""
+        reused = [t for t in tables if t in self.unchanged]
+        changed = [t for t in tables if t not in self.unchanged]
+        self.sections["profile"] = {"reused": reused, "recomputed": changed}
+        return changed, reused
+
+    def split_dq_scope(self, dq_scope):
+        """Returns (scope limited to changed tables, previous signals for unchanged tables)"""
+        checks = dq_scope.get("checks", [])
+        if self._signals is None:
+            pending, reused_signals = checks, []
+        else:
+            pending = [c for c in checks if not self._is_unchanged([c.get("table", "")])]
+            reused_signals = [s for s in self._signals if self._is_unchanged([s.get("table", "")])]
+
+        self.sections["data_quality"] = {
+            "reused": sorted({c.get("table") for c in checks} - {c.get("table") for c in pending}),
+            "recomputed": sorted({c.get("table") for c in pending})
+        }
+        return {**dq_scope, "checks": pending}, reused_signals
+
+    def summary(self):
+        return {
+            "base_load_id": self.base_load_id,
+            "unchanged_tables": sorted(self.unchanged),
+            "changed_tables": sorted(self.changed),
+            "sections": self.sections
+        }
+
+def session_names(session):
+    """(database, schema) of the session without identifier quotes"""
+    try:
+        return (
+            (session.get_current_database() or "").strip('"') or None,
+            (session.get_current_schema() or "").strip('"') or None
+        )
+    except Exception:
+        return None, None
+
+def get_latest_clean_report_for_schema(session, database, schema):
+    res = session.sql("""
+        SELECT CLEAN_JSON
+        FROM CLEAN_INSIGHTS_STORE
+        WHERE CLEAN_JSON:meta:database_analyzed::STRING = %s
+          AND CLEAN_JSON:meta:schema_analyzed::STRING = %s
+        ORDER BY LOAD_DATETIME DESC
+        LIMIT 1
+    """, params=[database, schema]).collect()
+
+    return parse_variant(res[0]["CLEAN_JSON"]) if res else None
+
+# =========================================================
+# PIPELINE STAGE GRAPH
+# =========================================================
+
+class Stage:
+    """A pipeline step and the names of the stage results it consumes"""
+
+    def __init__(self, name, fn, inputs=()):
+        self.name = name
+        self.fn = fn
+        self.inputs = tuple(inputs)
+
+def run_stage_graph(stages, max_workers=4, on_stage_done=None, on_stage_start=None):
+    """
+    Runs each stage on a worker pool as soon as all of its inputs
+    are available and returns {stage name: result}.
+    The first stage failure cancels stages not yet started, waits for
+    the running ones and is re-raised.
+    """
+    names = {s.name for s in stages}
+    for s in stages:
+        missing = [i for i in s.inputs if i not in names]
+        if missing:
+            raise ValueError(f"Stage '{s.name}' has unknown inputs: {missing}")
+
+    results = {}
+    pending = {s.name: s for s in stages}
+    running = {}
+    pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="pipeline")
+
+    try:
+        while pending or running:
+            ready = [s for s in pending.values() if all(i in results for i in s.inputs)]
+            for s in ready:
+                del pending[s.name]
+                if on_stage_start:
+                    on_stage_start(s.name)
+                future = pool.submit(s.fn, **{i: results[i] for i in s.inputs})
+                running[future] = s
+
+            if not running:
+                raise ValueError(f"Stage graph has a cycle: {sorted(pending)}")
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage = running.pop(future)
+                results[stage.name] = future.result()
+                if on_stage_done:
+                    on_stage_done(stage.name, results[stage.name])
+    except Exception:
+        # Stages already running still use the caller's session, which
+        # goes back to the pool once this returns: let them finish first
+        pool.shutdown(wait=True, cancel_futures=True)
+        raise
+
+    pool.shutdown(wait=True)
+    return results
+
+PIPELINE_MAX_WORKERS = session_workers(int(os.getenv("PIPELINE_MAX_WORKERS", "6")))
+
+# Stage results that are surfaced as report sections while the pipeline runs:
+# stage name -> (section name, payload builder)
+STREAM_SECTIONS = {
+    "metadata": ("metadata", lambda m: {
+        "tables_count": len(m),
+        "tables": [{"table": t, "columns": len(cols)} for t, cols in m.items()]
+    }),
+    "profile": ("profile", lambda p: p),
+    "relationships": ("relationships", lambda r: r.get("relationships", [])),
+    "kpis": ("kpis", lambda k: k),
+    "charts": ("charts", lambda c: c),
+    "quality": ("data_quality", lambda q: q),
+    "insights": ("insights", lambda i: i),
+}
+CORTEX_BATCH_PROMPTS = os.getenv("CORTEX_BATCH_PROMPTS", "true").lower() == "true"
+
+# Schema-level generators whose prompts depend only on metadata
+SCHEMA_AGENTS = {
+    "relationships": RelationshipAgent,
+    "kpi_defs": KPIGeneratorAgent,
+    "chart_defs": ChartGeneratorAgent,
+    "dq_scope": DataQualityScopeAgent,
+}
+
+def run_pipeline(session=None, selected_tables=None, use_cache=True, incremental=False,
+                 progress=None, on_section=None, chart_format="records", encoded=False):
+    """
+    progress: optional callback(step, state) with state "started" or
+    "finished", used by analysis jobs to report the current step.
+    on_section: optional callback(section, payload) invoked as soon as
+    each report section is ready, used by /run-analysis/stream.
+    chart_format: "records" or "columnar" shape for chart sample_data.
+    encoded: return (report, payload) where payload is the report's JSON
+    bytes as persisted, so callers can respond without encoding again.
+    """
+    if session is None:
+        print("\n📡 Borrowing pooled Snowflake session (environment credentials)...")
+        with pooled_env_session() as pooled:
+            return run_pipeline(pooled, selected_tables, use_cache, incremental,
+                                progress, on_section, chart_format, encoded)
+
+    progress = progress or (lambda step, state: None)
+
+    def stage_done(name, result):
+        progress(name, "finished")
+        if on_section and name in STREAM_SECTIONS:
+            section, build = STREAM_SECTIONS[name]
+            on_section(section, sanitize_for_json(build(result)))
 
-def store_clean_report(session, load_id, final_json):
-    session.sql("""
-        INSERT INTO CLEAN_INSIGHTS_STORE
-        (LOAD_ID, LOAD_DATETIME, CLEAN_JSON)
-        SELECT %s, CURRENT_TIMESTAMP(), PARSE_JSON(%s)
-    """, params=[
-        load_id,
-        json.dumps(final_json)
-    ]).collect()
-
-def run_pipeline(session=None, selected_tables=None):
     print("\n" + "="*60)
     print("🚀 STARTING DATA ANALYSIS PIPELINE")
     print("="*60)
-    
-    should_close_session = False
-    if session is None:
-        print("📡 Creating Snowflake session from environment variables...")
-        session = get_snowflake_session()
-        should_close_session = True
-    else:
-        print("📡 Using provided Snowflake session...")
-    
+
     load_id = str(uuid.uuid4())
     print(f"🆔 Load ID: {load_id}")
     
@@ -625,88 +2990,380 @@ def run_pipeline(session=None, selected_tables=None):
     else:
         print("📋 Analyzing ALL tables in schema")
 
-    print("\n🔍 Step 1: Extracting Metadata...")
-    metadata = MetadataAgent(session).run(selected_tables)
-    print(f"   ✅ Found {len(metadata)} table(s): {', '.join(metadata.keys())}")
-    
-    print("\n📊 Step 2: Profiling Data...")
-    profile = DataProfilerAgent(session).run(metadata.keys())
-    print(f"   ✅ Profiled {len(profile)} table(s)")
-    for table, info in profile.items():
-        if info.get('row_count'):
-            print(f"      • {table}: {info['row_count']:,} rows")
-    
-    print("\n🔗 Step 3: Analyzing Relationships...")
-    relationships = RelationshipAgent(session).run(metadata)
-    rel_count = len(relationships.get("relationships", []))
-    print(f"   ✅ Identified {rel_count} relationship(s)")
-
-    print("\n📈 Step 4: Generating KPIs...")
-    kpi_defs = KPIGeneratorAgent(session).run(metadata)
-    print(f"   ✅ Generated {len(kpi_defs.get('kpis', []))} KPI definition(s)")
-    
-    print("\n🔢 Step 5: Executing KPIs...")
-    kpis = KPIExecutionAgent(session).run(kpi_defs)
-    print(f"   ✅ Executed {len(kpis)} KPI(s)")
-    for kpi in kpis:
-        print(f"      • {kpi['name']}: {kpi['value']}")
-
-    print("\n📊 Step 6: Generating Charts...")
-    chart_defs = ChartGeneratorAgent(session).run(metadata)
-    print(f"   ✅ Generated {len(chart_defs.get('charts', []))} chart definition(s)")
-    
-    print("\n🎨 Step 7: Fetching Chart Data...")
-    charts = ChartDataAgent(session).run(chart_defs, metadata)
-    print(f"   ✅ Created {len(charts)} chart(s)")
-    for chart in charts:
-        print(f"      • {chart['name']} ({chart['chart_type']})")
-
-    print("\n🔍 Step 8: Identifying Data Quality Checks...")
-    dq_scope = DataQualityScopeAgent(session).run(metadata)
-    check_count = len(dq_scope.get("checks", []))
-    print(f"   ✅ Identified {check_count} data quality check(s)")
-
-    print("\n🧪 Step 9: Running Data Quality Checks...")
-    dq_signals = DataQualityProfiler(session).run(dq_scope)
-    print(f"   ✅ Found {len(dq_signals)} data quality signal(s)")
-
-    print("\n⚠️  Step 10: Analyzing Data Quality Issues...")
-    quality = DataQualityAgent(session).run(
-        metadata,
-        dq_signals
-    )
-    issue_count = len(quality.get("issues", []))
-    print(f"   ✅ Identified {issue_count} data quality issue(s)")
-    print(f"   📊 Overall Quality Score: {quality.get('overall_score', 'N/A')}/100")
-
-    print("\n💡 Step 11: Generating Insights...")
-    insights = NarrativeInsightAgent(session).run(
-        {"tables": list(metadata.keys())},
-        kpis,
-        quality,
-        quality.get("issues", [])
-    )
-    print(f"   ✅ Generated narrative insights")
+    if not use_cache:
+        print("♻️  Cortex response cache bypassed for this run")
+
+    database, schema = session_names(session)
 
-    print("\n📦 Step 12: Normalizing and Sanitizing Data...")
-    final = normalize(load_id, metadata, profile, relationships, kpis, charts, quality, insights)
-    final = sanitize_for_json(final)
-    print(f"   ✅ Data normalized")
+    def extract_metadata():
+        print("\n🔍 Extracting Metadata...")
+        metadata = MetadataAgent(session).run(selected_tables)
+        print(f"   ✅ Found {len(metadata)} table(s): {', '.join(metadata.keys())}")
+        return metadata
 
-    print("\n💾 Step 13: Persisting Report to Database...")
-    store_clean_report(session, load_id, final)
+    def read_table_stats(metadata):
+        try:
+            return fetch_table_stats(session, metadata.keys())
+        except Exception:
+            return {}
+
+    def build_plan(table_stats):
+        if not incremental:
+            return None
+        previous = get_latest_clean_report_for_schema(session, database, schema)
+        if not previous:
+            print("   ℹ️  [plan] No previous report for this schema; running a full analysis")
+            return None
+        plan = IncrementalPlan(previous, table_stats)
+        print(f"   ✅ [plan] {len(plan.unchanged)} unchanged / {len(plan.changed)} changed table(s) "
+              f"since load {plan.base_load_id}")
+        return plan
+
+    def profile_data(metadata, table_stats, plan):
+        tables = list(metadata.keys())
+        if plan:
+            tables, reused = plan.split_profile(tables)
+            profile = {t: table_stats[t] for t in reused}
+            profile.update(DataProfilerAgent(session).run(tables, table_stats))
+        else:
+            profile = DataProfilerAgent(session).run(tables, table_stats)
+        print(f"   ✅ [profile] Profiled {len(profile)} table(s)")
+        for table, info in profile.items():
+            if info.get('row_count'):
+                print(f"      • {table}: {info['row_count']:,} rows")
+        return profile
+
+    # Cortex only proposes relationships in augment mode, or as a fallback
+    # when local inference finds none; DQ scope is rule-based unless augmented
+    schema_agents = {
+        name: agent for name, agent in SCHEMA_AGENTS.items()
+        if (name != "relationships" or RELATIONSHIP_LLM_MODE == "augment")
+        and (name != "dq_scope" or DQ_SCOPE_LLM == "augment")
+    }
+
+    def run_schema_agents(metadata):
+        agents = {name: agent(session) for name, agent in schema_agents.items()}
+        shard_prompts = {name: agent.prompts(metadata) for name, agent in agents.items()}
+        prompts = {
+            f"{name}#{i}": prompt
+            for name, shards in shard_prompts.items()
+            for i, prompt in enumerate(shards)
+        }
+        responses = cortex_batch(session, prompts, use_cache=use_cache)
+        print(f"   ✅ [schema_responses] {len(responses)} Cortex prompt(s) answered in one statement")
+        return {
+            name: agents[name].merge([responses[f"{name}#{i}"] for i in range(len(shards))])
+            for name, shards in shard_prompts.items()
+        }
+
+    def analyze_relationships(metadata, table_stats, schema_responses=None):
+        try:
+            inferred = RelationshipInferenceAgent(session).run(metadata, table_stats)["relationships"]
+        except Exception as e:
+            print(f"   ⚠️  [relationships] Local inference failed: {str(e)}")
+            inferred = []
+        print(f"   ✅ [relationships] Inferred {len(inferred)} relationship(s) from data")
+
+        suggested = []
+        if RELATIONSHIP_LLM_MODE == "augment" or (RELATIONSHIP_LLM_MODE == "fallback" and not inferred):
+            if schema_responses is not None and "relationships" in schema_responses:
+                suggested = schema_responses["relationships"].get("relationships", [])
+            else:
+                suggested = RelationshipAgent(session, use_cache=use_cache).run(metadata).get("relationships", [])
+
+        relationships = {"relationships": merge_relationships(inferred, suggested)}
+        print(f"   ✅ [relationships] Identified {len(relationships['relationships'])} relationship(s)")
+        return relationships
+
+    def generate_kpis(metadata, schema_responses=None):
+        if schema_responses is not None:
+            kpi_defs = schema_responses["kpi_defs"]
+        else:
+            kpi_defs = KPIGeneratorAgent(session, use_cache=use_cache).run(metadata)
+        print(f"   ✅ [kpi_defs] Generated {len(kpi_defs.get('kpis', []))} KPI definition(s)")
+        return kpi_defs
+
+    # Column statistics are computed once, by whichever of their own stage
+    # or a KPI / chart repair or fallback asks first; pass 1 never waits
+    column_stats_lock = threading.Lock()
+    column_stats_result = {}
+
+    def column_stats_for(metadata, table_stats):
+        with column_stats_lock:
+            if "stats" not in column_stats_result:
+                try:
+                    column_stats_result["stats"] = ColumnStatisticsAgent(session).run(metadata, table_stats)
+                except Exception as e:
+                    print(f"   ⚠️  [column_stats] Column statistics failed: {str(e)}")
+                    column_stats_result["stats"] = {}
+            return column_stats_result["stats"]
+
+    def compute_column_stats(metadata, table_stats):
+        return column_stats_for(metadata, table_stats)
+
+    def execute_kpis(kpi_defs, metadata, table_stats, plan):
+        kpis = KPIExecutionAgent(session, table_versions(table_stats), row_counts(table_stats)).run(
+            kpi_defs,
+            reuse=plan.reuse_kpi if plan else None,
+            fallback=lambda: fallback_kpi_defs(metadata, column_stats_for(metadata, table_stats))
+        )
+        print(f"   ✅ [kpis] Executed {len(kpis)} KPI(s)")
+        for kpi in kpis:
+            print(f"      • {kpi['name']}: {kpi['value']}")
+        return kpis
+
+    def generate_charts(metadata, schema_responses=None):
+        if schema_responses is not None:
+            chart_defs = schema_responses["chart_defs"]
+        else:
+            chart_defs = ChartGeneratorAgent(session, use_cache=use_cache).run(metadata)
+        print(f"   ✅ [chart_defs] Generated {len(chart_defs.get('charts', []))} chart definition(s)")
+        return chart_defs
+
+    def fetch_chart_data(chart_defs, metadata, table_stats, plan):
+        charts = ChartDataAgent(
+            session, table_versions(table_stats), chart_format, row_counts(table_stats)
+        ).run(
+            chart_defs, metadata, reuse=plan.reuse_chart if plan else None,
+            column_stats=lambda: column_stats_for(metadata, table_stats)
+        )
+        print(f"   ✅ [charts] Created {len(charts)} chart(s)")
+        for chart in charts:
+            print(f"      • {chart['name']} ({chart['chart_type']})")
+        return charts
+
+    def identify_dq_checks(metadata, schema_responses=None):
+        dq_scope = rule_dq_scope(metadata)
+        if DQ_SCOPE_LLM == "augment":
+            if schema_responses is not None and "dq_scope" in schema_responses:
+                suggested = schema_responses["dq_scope"]
+            else:
+                suggested = DataQualityScopeAgent(session, use_cache=use_cache).run(metadata)
+            dq_scope = {"checks": dq_scope["checks"] + (suggested or {}).get("checks", [])}
+        dq_scope = validate_dq_scope(dq_scope, metadata)
+        print(f"   ✅ [dq_scope] Identified {len(dq_scope.get('checks', []))} data quality check(s)")
+        return dq_scope
+
+    def run_dq_checks(dq_scope, plan, profile):
+        # Row counts from the profiler switch huge tables to approximate checks
+        profiler = DataQualityProfiler(session, row_counts(profile))
+        if plan:
+            dq_scope, reused_signals = plan.split_dq_scope(dq_scope)
+            dq_signals = reused_signals + profiler.run(dq_scope)
+        else:
+            dq_signals = profiler.run(dq_scope)
+        print(f"   ✅ [dq_signals] Found {len(dq_signals)} data quality signal(s)")
+        return dq_signals
+
+    def analyze_quality(metadata, dq_signals):
+        quality = DataQualityAgent(session, use_cache=use_cache).run(metadata, dq_signals)
+        print(f"   ✅ [quality] Identified {len(quality.get('issues', []))} data quality issue(s)")
+        print(f"   📊 Overall Quality Score: {quality.get('overall_score', 'N/A')}/100")
+        return quality
+
+    def generate_insights(metadata, kpis, quality):
+        insights = NarrativeInsightAgent(session, use_cache=use_cache).run(
+            {"tables": list(metadata.keys())},
+            kpis,
+            quality,
+            quality.get("issues", [])
+        )
+        print(f"   ✅ [insights] Generated narrative insights")
+        return insights
+
+    # In batch mode the four schema-level prompts share one Cortex
+    # statement and each generator stage just picks its response.
+    schema_inputs = ["metadata", "schema_responses"] if CORTEX_BATCH_PROMPTS else ["metadata"]
+
+    # Each stage declares the results it needs; independent stages
+    # run concurrently once MetadataAgent has returned.
+    stages = [
+        Stage("metadata", extract_metadata),
+        Stage("table_stats", read_table_stats, ["metadata"]),
+        Stage("plan", build_plan, ["table_stats"]),
+        Stage("profile", profile_data, ["metadata", "table_stats", "plan"]),
+        Stage("relationships", analyze_relationships, ["metadata", "table_stats"] + schema_inputs[1:]),
+        Stage("column_stats", compute_column_stats, ["metadata", "table_stats"]),
+        Stage("kpi_defs", generate_kpis, schema_inputs),
+        Stage("kpis", execute_kpis, ["kpi_defs", "metadata", "table_stats", "plan"]),
+        Stage("chart_defs", generate_charts, schema_inputs),
+        Stage("charts", fetch_chart_data, ["chart_defs", "metadata", "table_stats", "plan"]),
+        Stage("dq_scope", identify_dq_checks, schema_inputs),
+        Stage("dq_signals", run_dq_checks, ["dq_scope", "plan", "profile"]),
+        Stage("quality", analyze_quality, ["metadata", "dq_signals"]),
+        Stage("insights", generate_insights, ["metadata", "kpis", "quality"]),
+    ]
+    if CORTEX_BATCH_PROMPTS:
+        stages.append(Stage("schema_responses", run_schema_agents, ["metadata"]))
+
+    print(f"\n⚙️  Running {len(stages)} stages on up to {PIPELINE_MAX_WORKERS} workers...")
+    started = time.monotonic()
+    r = run_stage_graph(
+        stages,
+        max_workers=PIPELINE_MAX_WORKERS,
+        on_stage_start=lambda name: progress(name, "started"),
+        on_stage_done=stage_done
+    )
+    print(f"   ⏱️  Stages finished in {time.monotonic() - started:.1f}s")
+    print(f"   🗃️  Cortex cache: {CORTEX_CACHE.stats()}")
+    print(f"   🗃️  Query result cache: {QUERY_RESULT_CACHE.stats()}")
+
+    print("\n📦 Normalizing and Encoding Data...")
+    progress("normalize", "started")
+    final = normalize(
+        load_id, r["metadata"], r["profile"], r["relationships"],
+        r["kpis"], r["charts"], r["quality"], r["insights"],
+        signals=r["dq_signals"], database=database, schema=schema,
+        incremental=r["plan"].summary() if r["plan"] else None
+    )
+    # Encoded once; the same bytes are persisted and sent to the client
+    payload = encode_json(final)
+    print(f"   ✅ Data normalized ({len(payload)} bytes)")
+    progress("normalize", "finished")
+
+    print("\n💾 Persisting Report to Database...")
+    progress("persist", "started")
+    store_clean_report(session, load_id, final, payload)
     print(f"   ✅ Report saved successfully")
+    progress("persist", "finished")
 
-    if should_close_session:
-        session.close()
-        print("\n🔌 Snowflake session closed")
-    
     print("\n" + "="*60)
     print("✨ PIPELINE COMPLETED SUCCESSFULLY")
     print("="*60 + "\n")
-    
+
+    if encoded:
+        return final, payload
     return final
 
+# =========================================================
+# ANALYSIS JOBS
+# =========================================================
+
+class AnalysisJobManager:
+    """
+    Runs pipelines on a bounded worker pool so /analysis-jobs can return
+    a job id immediately. Submissions are rejected once `max_queue` jobs
+    are queued or running. Finished jobs are kept for `retention` seconds;
+    their encoded reports are held within `max_result_bytes` (oldest
+    dropped first) and stay available through /clean-report/<load_id>.
+    """
+
+    def __init__(self, max_workers=2, max_queue=8, retention=3600, max_result_bytes=64 * 1024 * 1024):
+        self.max_queue = max_queue
+        self.retention = retention
+        self.max_result_bytes = max_result_bytes
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="analysis-job")
+        self._lock = threading.Lock()
+        self._jobs = OrderedDict()      # job id -> status record
+        self._results = OrderedDict()   # job id -> encoded report, oldest first
+        self._result_bytes = 0
+
+    def _prune(self):
+        now = time.time()
+        for job_id, job in list(self._jobs.items()):
+            if job["finished_at"] and now - job["finished_at"] > self.retention:
+                del self._jobs[job_id]
+                self._drop_result(job_id)
+
+    def _drop_result(self, job_id):
+        payload = self._results.pop(job_id, None)
+        if payload is not None:
+            self._result_bytes -= len(payload)
+
+    def _keep_result(self, job_id, payload):
+        if len(payload) > self.max_result_bytes:
+            return
+        self._results[job_id] = payload
+        self._result_bytes += len(payload)
+        while self._result_bytes > self.max_result_bytes:
+            self._drop_result(next(iter(self._results)))
+
+    def _active(self):
+        return sum(1 for j in self._jobs.values() if j["status"] in ("queued", "running"))
+
+    def submit(self, run):
+        """
+        run(progress) -> (report, payload bytes). Returns the job record,
+        or None when the queue is full.
+        """
+        with self._lock:
+            self._prune()
+            if self._active() >= self.max_queue:
+                return None
+
+            job_id = str(uuid.uuid4())
+            self._jobs[job_id] = {
+                "job_id": job_id,
+                "status": "queued",
+                "current_step": None,
+                "running_steps": [],
+                "completed_steps": [],
+                "submitted_at": time.time(),
+                "started_at": None,
+                "finished_at": None,
+                "load_id": None,
+                "error": None
+            }
+            job = dict(self._jobs[job_id])
+
+        self._executor.submit(self._run, job_id, run)
+        return job
+
+    def _update(self, job_id, **fields):
+        with self._lock:
+            self._jobs[job_id].update(fields)
+
+    def _progress(self, job_id, step, state):
+        with self._lock:
+            job = self._jobs[job_id]
+            running = [s for s in job["running_steps"] if s != step]
+            if state == "started":
+                running.append(step)
+            else:
+                job["completed_steps"] = job["completed_steps"] + [step]
+            job["running_steps"] = running
+            job["current_step"] = running[-1] if running else None
+
+    def _run(self, job_id, run):
+        self._update(job_id, status="running", started_at=time.time())
+        try:
+            report, payload = run(lambda step, state: self._progress(job_id, step, state))
+            with self._lock:
+                self._keep_result(job_id, payload)
+            self._update(
+                job_id,
+                status="succeeded",
+                current_step=None,
+                load_id=report.get("meta", {}).get("load_id"),
+                finished_at=time.time()
+            )
+        except Exception as e:
+            print(f"Analysis job {job_id} failed: {str(e)}")
+            self._update(job_id, status="failed", error=str(e), finished_at=time.time())
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+    def result(self, job_id):
+        with self._lock:
+            return self._results.get(job_id)
+
+ANALYSIS_JOBS = AnalysisJobManager(
+    max_workers=int(os.getenv("ANALYSIS_JOB_WORKERS", "2")),
+    max_queue=int(os.getenv("ANALYSIS_JOB_MAX_QUEUE", "8")),
+    retention=int(os.getenv("ANALYSIS_JOB_RETENTION", "3600")),
+    max_result_bytes=int(os.getenv("ANALYSIS_JOB_RESULT_MAX_BYTES", str(64 * 1024 * 1024)))
+)
+
+def request_flag(name):
+    """Reads a boolean flag from the query string, form data or JSON body"""
+    value = request.args.get(name) or request.form.get(name)
+    if value is None and request.is_json:
+        value = (request.get_json(silent=True) or {}).get(name)
+    return str(value).lower() in ("1", "true", "yes")
+
 def parse_variant(value):
     """
     Safely converts Snowflake VARIANT to Python dict
@@ -731,7 +3388,16 @@ def parse_variant(value):
 def home():
     return jsonify({
         "service": "Snowflake Cortex Data Intelligence API",
-        "endpoints": ["/run-analysis", "/list-tables", "/clean-report", "/clean-report/runs", "/clean-report/<load_id>"]
+        "endpoints": ["/run-analysis", "/list-tables", "/clean-report", "/clean-report/runs", "/clean-report/<load_id>", "/run-analysis/stream", "/analysis-jobs", "/cache-stats"]
+    })
+
+@app.route("/cache-stats", methods=["GET"])
+def cache_stats():
+    return jsonify({
+        "cortex": CORTEX_CACHE.stats(),
+        "query_results": QUERY_RESULT_CACHE.stats(),
+        "reports": REPORT_CACHE.stats(),
+        "chat_answers": CHAT_ANSWER_CACHE.stats()
     })
 
 @app.route("/list-tables", methods=["POST"])
@@ -752,217 +3418,636 @@ def list_tables():
         if not all([account, user, role, warehouse, database, schema, private_key_file]):
             return jsonify({"status": "error", "message": "Missing required fields"}), 400
 
-        # Save private key to temporary file
-        with tempfile.NamedTemporaryFile(mode='wb', suffix='.pem', delete=False) as tmp_file:
-            private_key_file.save(tmp_file)
-            tmp_key_path = tmp_file.name
+        # Key material stays in memory; decoded DER is cached by KEY_CACHE
+        private_key_pem = private_key_file.read()
 
-        try:
-            # Create Snowflake session with provided credentials
-            session = get_snowflake_session_dynamic(
-                account, user, role, warehouse, database, schema, 
-                tmp_key_path, private_key_passphrase
-            )
-
-            # Fetch all tables in the schema
-            tables_df = session.sql("""
-                SELECT TABLE_NAME
-                FROM INFORMATION_SCHEMA.TABLES
-                WHERE TABLE_SCHEMA = CURRENT_SCHEMA()
-                ORDER BY TABLE_NAME
-            """).to_pandas()
+        # Borrow a pooled Snowflake session for the provided credentials
+        with pooled_session(
+            account, user, role, warehouse, database, schema,
+            private_key_pem, private_key_passphrase
+        ) as session:
+            # Fetch all tables in the schema; the listing doubles as the
+            # version check for the metadata cache used by /run-analysis
+            versions = fetch_table_versions(session)
+            METADATA_CACHE.record_versions(schema_cache_key(session), versions)
 
-            tables = tables_df['TABLE_NAME'].tolist()
-            
-            session.close()
-            
-            return jsonify({
-                "status": "success",
-                "tables": tables,
-                "count": len(tables)
-            })
+        tables = list(versions)
 
-        finally:
-            # Clean up temporary file
-            if os.path.exists(tmp_key_path):
-                os.remove(tmp_key_path)
+        return jsonify({
+            "status": "success",
+            "tables": tables,
+            "count": len(tables)
+        })
 
     except Exception as e:
         print(f"Error listing tables: {str(e)}")
         return jsonify({"status": "error", "message": str(e)}), 500
 
+def parse_analysis_request(env_credentials=False):
+    """
+    Reads /run-analysis style inputs and returns (run, error_response).
+    `run(progress=None, on_section=None)` borrows a pooled session, runs
+    the pipeline and returns (report, payload) with the encoded JSON bytes;
+    it can also execute after the request has returned.
+    """
+    use_cache = not request_flag("bypass_cache")
+    incremental = request_flag("incremental")
+    chart_format = "columnar" if (
+        request.args.get("chart_format") or request.form.get("chart_format")
+    ) == "columnar" else "records"
+
+    if env_credentials:
+        # Legacy: .env credentials, all tables unless some were given
+        tables_json = request.form.get('tables')
+        try:
+            selected_tables = json.loads(tables_json) if tables_json else None
+        except Exception:
+            return None, (jsonify({"status": "error", "message": "Invalid tables JSON"}), 400)
+
+        def run(progress=None, on_section=None):
+            return run_pipeline(
+                None, selected_tables,
+                use_cache=use_cache, incremental=incremental,
+                progress=progress, on_section=on_section, chart_format=chart_format,
+                encoded=True
+            )
+        return run, None
+
+    # Get form data
+    account = request.form.get('account')
+    user = request.form.get('user')
+    role = request.form.get('role')
+    warehouse = request.form.get('warehouse')
+    database = request.form.get('database')
+    schema = request.form.get('schema')
+    private_key_file = request.files.get('private_key_file')
+    private_key_passphrase = request.form.get('private_key_passphrase') or None
+    tables_json = request.form.get('tables')
+
+    # Validate required fields
+    if not all([account, user, role, warehouse, database, schema, private_key_file, tables_json]):
+        return None, (jsonify({"status": "error", "message": "Missing required fields"}), 400)
+
+    # Parse selected tables
+    try:
+        selected_tables = json.loads(tables_json)
+    except Exception:
+        return None, (jsonify({"status": "error", "message": "Invalid tables JSON"}), 400)
+
+    # Key material stays in memory; decoded DER is cached by KEY_CACHE
+    private_key_pem = private_key_file.read()
+
+    def run(progress=None, on_section=None):
+        # Borrow a pooled Snowflake session for the provided credentials
+        with pooled_session(
+            account, user, role, warehouse, database, schema,
+            private_key_pem, private_key_passphrase
+        ) as session:
+            # Run pipeline with selected tables
+            return run_pipeline(
+                session, selected_tables,
+                use_cache=use_cache, incremental=incremental,
+                progress=progress, on_section=on_section, chart_format=chart_format,
+                encoded=True
+            )
+    return run, None
+
 @app.route("/run-analysis", methods=["GET", "POST"])
 def run_analysis():
     try:
-        # Handle POST request with credentials and table selection
-        if request.method == "POST":
-            # Get form data
-            account = request.form.get('account')
-            user = request.form.get('user')
-            role = request.form.get('role')
-            warehouse = request.form.get('warehouse')
-            database = request.form.get('database')
-            schema = request.form.get('schema')
-            private_key_file = request.files.get('private_key_file')
-            private_key_passphrase = request.form.get('private_key_passphrase') or None
-            tables_json = request.form.get('tables')
-
-            # Validate required fields
-            if not all([account, user, role, warehouse, database, schema, private_key_file, tables_json]):
-                return jsonify({"status": "error", "message": "Missing required fields"}), 400
-
-            # Parse selected tables
-            try:
-                selected_tables = json.loads(tables_json)
-            except:
-                return jsonify({"status": "error", "message": "Invalid tables JSON"}), 400
+        # POST carries credentials and table selection; GET is legacy .env support
+        run, error = parse_analysis_request(env_credentials=request.method == "GET")
+        if error:
+            return error
+
+        report, payload = run()
+        return success_response(payload)
+
+    except Exception as e:
+        print(f"Error running analysis: {str(e)}")
+        return jsonify({"status": "error", "message": str(e)}), 500
 
-            # Save private key to temporary file
-            with tempfile.NamedTemporaryFile(mode='wb', suffix='.pem', delete=False) as tmp_file:
-                private_key_file.save(tmp_file)
-                tmp_key_path = tmp_file.name
+STREAM_HEARTBEAT_SECONDS = int(os.getenv("STREAM_HEARTBEAT_SECONDS", "15"))
 
+@app.route("/run-analysis/stream", methods=["GET", "POST"])
+def run_analysis_stream():
+    """
+    Streams report sections as NDJSON (or Server-Sent Events with
+    ?format=sse) as soon as each pipeline stage finishes, ending with
+    the persisted load_id. Runs on the analysis job pool.
+    """
+    try:
+        run, error = parse_analysis_request(env_credentials=request.method == "GET")
+        if error:
+            return error
+
+        events = queue.Queue()
+
+        def streamed_run(progress):
             try:
-                # Create Snowflake session with provided credentials
-                session = get_snowflake_session_dynamic(
-                    account, user, role, warehouse, database, schema, 
-                    tmp_key_path, private_key_passphrase
-                )
+                report, payload = run(progress, on_section=lambda section, data: events.put(
+                    {"event": "section", "section": section, "data": data}
+                ))
+                events.put({"event": "done", "load_id": report["meta"]["load_id"]})
+                return report, payload
+            except Exception as e:
+                events.put({"event": "error", "message": str(e)})
+                raise
+
+        job = ANALYSIS_JOBS.submit(streamed_run)
+        if job is None:
+            return jsonify({
+                "status": "error",
+                "message": "Too many analyses queued, try again later"
+            }), 429
 
-                # Run pipeline with selected tables
-                result = run_pipeline(session, selected_tables)
-                
-                session.close()
-                
-                return jsonify({"status": "success", "data": result})
+        sse = request.args.get("format") == "sse"
+
+        def encode(event):
+            line = json.dumps(event)
+            return f"data: {line}\n\n" if sse else line + "\n"
+
+        def generate():
+            yield encode({"event": "started", "job_id": job["job_id"]})
+            while True:
+                try:
+                    event = events.get(timeout=STREAM_HEARTBEAT_SECONDS)
+                except queue.Empty:
+                    # Keeps proxies from closing an idle connection
+                    yield encode({"event": "heartbeat"})
+                    continue
+                yield encode(event)
+                if event["event"] in ("done", "error"):
+                    break
+
+        return Response(
+            generate(),
+            mimetype="text/event-stream" if sse else "application/x-ndjson",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+        )
 
-            finally:
-                # Clean up temporary file
-                if os.path.exists(tmp_key_path):
-                    os.remove(tmp_key_path)
-        
-        # Handle GET request (legacy support)
-        else:
-            return jsonify({"status": "success", "data": run_pipeline()})
-            
     except Exception as e:
-        print(f"Error running analysis: {str(e)}")
+        print(f"Error streaming analysis: {str(e)}")
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+@app.route("/analysis-jobs", methods=["POST"])
+def submit_analysis_job():
+    """
+    Queues an analysis and returns a job id immediately.
+    Accepts the same form fields as POST /run-analysis; without
+    credentials the .env connection is used.
+    """
+    try:
+        run, error = parse_analysis_request(env_credentials="account" not in request.form)
+        if error:
+            return error
+
+        job = ANALYSIS_JOBS.submit(run)
+        if job is None:
+            return jsonify({
+                "status": "error",
+                "message": "Too many analyses queued, try again later"
+            }), 429
+
+        return jsonify({"status": "accepted", **job}), 202
+
+    except Exception as e:
+        print(f"Error submitting analysis job: {str(e)}")
         return jsonify({"status": "error", "message": str(e)}), 500
 
+@app.route("/analysis-jobs/<job_id>", methods=["GET"])
+def analysis_job_status(job_id):
+    job = ANALYSIS_JOBS.get(job_id)
+    if not job:
+        return jsonify({"status": "error", "message": "Job not found"}), 404
+    return jsonify(job)
+
+@app.route("/analysis-jobs/<job_id>/result", methods=["GET"])
+def analysis_job_result(job_id):
+    job = ANALYSIS_JOBS.get(job_id)
+    if not job:
+        return jsonify({"status": "error", "message": "Job not found"}), 404
+
+    if job["status"] == "failed":
+        return jsonify({"status": "error", "job_id": job_id, "message": job["error"]}), 500
+
+    if job["status"] != "succeeded":
+        return jsonify(job), 202
+
+    payload = ANALYSIS_JOBS.result(job_id)
+    if payload is not None:
+        return success_response(payload)
+
+    # Evicted from the job results; the persisted report may still be cached or in the .env store
+    try:
+        report = load_clean_report(job["load_id"]) if job["load_id"] else None
+    except Exception as e:
+        print(f"Error loading report for job {job_id}: {str(e)}")
+        report = None
+    if report is None:
+        return jsonify({
+            "status": "error",
+            "job_id": job_id,
+            "load_id": job["load_id"],
+            "message": "Job result no longer retained; the report was stored under its load_id"
+        }), 410
+    return success_response(report[2])
+
 @app.route("/run-analysis-legacy", methods=["GET"])
 def run_analysis_legacy():
     """Legacy endpoint using .env credentials"""
     try:
-        return jsonify({"status": "success", "data": run_pipeline()})
+        report, payload = run_pipeline(encoded=True)
+        return success_response(payload)
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
 
+def report_response(report, with_status=True):
+    """JSON response around a cached report's bytes, tagged with its ETag"""
+    load_id, load_datetime, payload = report
+    head = {"status": "success"} if with_status else {}
+    head.update(load_id=load_id, load_datetime=load_datetime)
+    response = Response(
+        json.dumps(head)[:-1].encode("utf-8") + b', "data": ' + payload + b"}",
+        mimetype="application/json"
+    )
+    response.set_etag(report_etag(load_id))
+    return response
+
+def not_modified(load_id):
+    """304 when the client already holds load_id's report, else None"""
+    if load_id and request.if_none_match.contains(report_etag(load_id)):
+        response = Response(status=304)
+        response.set_etag(report_etag(load_id))
+        return response
+    return None
+
 @app.route("/clean-report", methods=["GET"])
 @app.route("/clean-report/<load_id>", methods=["GET"])
 def clean_report(load_id=None):
-    session = get_snowflake_session()
-
-    if load_id:
-        query = """
-            SELECT LOAD_ID, LOAD_DATETIME, CLEAN_JSON
-            FROM CLEAN_INSIGHTS_STORE
-            WHERE LOAD_ID = %s
-            ORDER BY LOAD_DATETIME DESC
-            LIMIT 1
-        """
-        res = session.sql(query, params=[load_id]).collect()
-    else:
-        query = """
-            SELECT LOAD_ID, LOAD_DATETIME, CLEAN_JSON
-            FROM CLEAN_INSIGHTS_STORE
-            ORDER BY LOAD_DATETIME DESC
-            LIMIT 1
-        """
-        res = session.sql(query).collect()
-
-    session.close()
+    """
+    Reports are immutable, so a matching If-None-Match is answered with
+    304 without touching Snowflake; so is /clean-report while the cached
+    latest pointer is fresh.
+    """
+    cached = not_modified(load_id or REPORT_CACHE.latest())
+    if cached:
+        return cached
 
-    if not res:
+    report = load_clean_report(load_id)
+    if not report:
         return jsonify({
             "status": "error",
             "message": "No report found for given load_id" if load_id else "No reports found"
         }), 404
 
-    clean_json = parse_variant(res[0]["CLEAN_JSON"])
+    return not_modified(report[0]) or report_response(report)
 
-    return jsonify({
-        "status": "success",
-        "load_id": res[0]["LOAD_ID"],
-        "load_datetime": str(res[0]["LOAD_DATETIME"]),
-        "data": clean_json
-    })
+RUNS_PAGE_SIZE = int(os.getenv("RUNS_PAGE_SIZE", "50"))
+RUNS_PAGE_MAX = int(os.getenv("RUNS_PAGE_MAX", "200"))
 
-@app.route("/clean-report/runs", methods=["GET"])
-def list_clean_report_runs():
-    session = get_snowflake_session()
+def encode_runs_cursor(load_datetime, load_id):
+    raw = json.dumps([load_datetime, load_id]).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii")
 
-    res = session.sql("""
-        SELECT
-            LOAD_ID,
-            LOAD_DATETIME
-        FROM CLEAN_INSIGHTS_STORE
-        ORDER BY LOAD_DATETIME DESC
-    """).collect()
+def decode_runs_cursor(cursor):
+    """(load_datetime, load_id) from an opaque cursor; ValueError if malformed"""
+    try:
+        load_datetime, load_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except Exception:
+        raise ValueError("Invalid cursor")
+    if not isinstance(load_datetime, str) or not isinstance(load_id, str):
+        raise ValueError("Invalid cursor")
+    return load_datetime, load_id
 
-    session.close()
+@app.route("/clean-report/runs", methods=["GET"])
+def list_clean_report_runs():
+    """
+    Newest runs first, paginated on (LOAD_DATETIME, LOAD_ID).
+    ?limit= caps the page size at RUNS_PAGE_MAX; when more runs exist the
+    X-Next-Cursor header carries the ?cursor= for the next page.
+    """
+    try:
+        limit = min(max(int(request.args.get("limit", RUNS_PAGE_SIZE)), 1), RUNS_PAGE_MAX)
+        cursor = request.args.get("cursor")
+        after = decode_runs_cursor(cursor) if cursor else None
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+
+    where, params = "", []
+    if after:
+        where = """
+            WHERE LOAD_DATETIME < TO_TIMESTAMP_NTZ(%s)
+               OR (LOAD_DATETIME = TO_TIMESTAMP_NTZ(%s) AND LOAD_ID < %s)
+        """
+        params = [after[0], after[0], after[1]]
+
+    with pooled_env_session() as session:
+        res = session.sql(f"""
+            SELECT
+                LOAD_ID,
+                LOAD_DATETIME,
+                TABLES_COUNT,
+                QUALITY_SCORE,
+                SCHEMA_NAME
+            FROM CLEAN_INSIGHTS_STORE
+            {where}
+            ORDER BY LOAD_DATETIME DESC, LOAD_ID DESC
+            LIMIT {limit + 1}
+        """, params=params).collect()
 
-    return jsonify([
+    page = res[:limit]
+    response = jsonify([
         {
             "load_id": r["LOAD_ID"],
-            "load_datetime": str(r["LOAD_DATETIME"])
+            "load_datetime": str(r["LOAD_DATETIME"]),
+            "tables_count": r["TABLES_COUNT"],
+            "quality_score": r["QUALITY_SCORE"],
+            "schema": r["SCHEMA_NAME"]
         }
-        for r in res
+        for r in page
     ])
+    if len(res) > limit:
+        last = page[-1]
+        response.headers["X-Next-Cursor"] = encode_runs_cursor(
+            str(last["LOAD_DATETIME"]), last["LOAD_ID"]
+        )
+    return response
 
 @app.route("/clean-report/<load_id>", methods=["GET"])
 def get_clean_report_by_id(load_id):
-    session = get_snowflake_session()
-    
-    res = session.sql("""
-        SELECT LOAD_ID, LOAD_DATETIME, CLEAN_JSON
-        FROM CLEAN_INSIGHTS_STORE
-        WHERE LOAD_ID = %s
-    """, params=[load_id]).collect()
-    
-    session.close()
+    cached = not_modified(load_id)
+    if cached:
+        return cached
 
-    if not res:
+    report = load_clean_report(load_id)
+    if not report:
         return jsonify({"error": "Report not found"}), 404
 
-    clean_json_raw = res[0]["CLEAN_JSON"]
-
-    # Snowflake VARIANT may come as string → force parse
-    if isinstance(clean_json_raw, str):
-        clean_json = json.loads(clean_json_raw)
-    else:
-        clean_json = clean_json_raw
+    return report_response(report, with_status=False)
 
-    return jsonify({
-        "load_id": res[0]["LOAD_ID"],
-        "load_datetime": str(res[0]["LOAD_DATETIME"]),
-        "data": clean_json
-    })
 def get_latest_clean_report(session):
-    res = session.sql("""
-        SELECT LOAD_ID, LOAD_DATETIME, CLEAN_JSON
-        FROM CLEAN_INSIGHTS_STORE
-        ORDER BY LOAD_DATETIME DESC
-        LIMIT 1
-    """).collect()
-
-    if not res:
+    report = load_clean_report(session=session)
+    if not report:
         return None
 
+    load_id, load_datetime, payload = report
     return {
-        "load_id": res[0]["LOAD_ID"],
-        "load_datetime": str(res[0]["LOAD_DATETIME"]),
-        "data": parse_variant(res[0]["CLEAN_JSON"])
+        "load_id": load_id,
+        "load_datetime": load_datetime,
+        "payload": payload
     }
+# =========================================================
+# CHAT RETRIEVAL
+# =========================================================
+
+CHAT_CONTEXT_TOP_K = int(os.getenv("CHAT_CONTEXT_TOP_K", "8"))
+CHAT_CONTEXT_TOKEN_BUDGET = int(os.getenv("CHAT_CONTEXT_TOKEN_BUDGET", "3000"))
+CHAT_INDEX_MAX_ENTRIES = int(os.getenv("CHAT_INDEX_MAX_ENTRIES", "16"))
+
+def search_tokens(text):
+    """Lowercase words; SNAKE_CASE identifiers also yield their parts"""
+    tokens = []
+    for word in re.findall(r"[A-Za-z0-9_]+", text.lower()):
+        tokens.append(word)
+        parts = [p for p in word.split("_") if p]
+        if len(parts) > 1:
+            tokens.extend(parts)
+    return tokens
+
+def report_sections(report):
+    """
+    Splits a stored report into an always-sent overview and retrievable
+    sections: one per table (with its relationships and DQ signals), KPI,
+    chart and data quality issue.
+    """
+    understanding = report.get("understanding", {})
+    quality = report.get("data_quality", {})
+    relationships = understanding.get("relationships", []) or []
+    signals = quality.get("signals", []) or []
+
+    overview = {
+        "meta": report.get("meta", {}),
+        "summary": report.get("summary", {}),
+        "insights": report.get("insights", {}),
+        "data_quality": {k: v for k, v in quality.items() if k not in ("issues", "signals")}
+    }
+    if report.get("incremental"):
+        overview["incremental"] = report["incremental"]
+
+    sections = []
+    for table in understanding.get("tables", []):
+        name = table.get("table")
+        sections.append({
+            "table": table,
+            "relationships": [
+                r for r in relationships
+                if isinstance(r, dict) and name in (r.get("table1"), r.get("table2"))
+            ],
+            "dq_signals": [s for s in signals if isinstance(s, dict) and s.get("table") == name]
+        })
+    sections += [{"kpi": k} for k in report.get("kpis", [])]
+    sections += [{"chart": c} for c in report.get("charts", [])]
+    sections += [{"data_quality_issue": i} for i in quality.get("issues", [])]
+    return overview, sections
+
+class ReportIndex:
+    """BM25 index over the sections of one report"""
+
+    k1 = 1.5
+    b = 0.75
+
+    def __init__(self, report):
+        self.overview, self.sections = report_sections(report)
+        self.texts = [json.dumps(s, default=json_default) for s in self.sections]
+        self.overview_text = json.dumps(self.overview, default=json_default)
+        self.term_freqs = [Counter(search_tokens(t)) for t in self.texts]
+        self.lengths = [sum(tf.values()) for tf in self.term_freqs]
+        self.avg_length = (sum(self.lengths) / len(self.lengths)) if self.lengths else 0
+        self.doc_freqs = Counter(term for tf in self.term_freqs for term in tf)
+
+    def scores(self, question):
+        n = len(self.sections)
+        terms = set(search_tokens(question))
+        scores = []
+        for tf, length in zip(self.term_freqs, self.lengths):
+            score = 0.0
+            for term in terms:
+                f = tf.get(term)
+                if not f:
+                    continue
+                df = self.doc_freqs[term]
+                idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+                norm = self.k1 * (1 - self.b + self.b * length / (self.avg_length or 1))
+                score += idf * f * (self.k1 + 1) / (f + norm)
+            scores.append(score)
+        return scores
+
+    def context(self, question, top_k=8, token_budget=3000):
+        """
+        The overview plus the best-matching sections, at most top_k and
+        within token_budget (estimated at ~4 characters per token). When
+        nothing matches, sections are taken in report order.
+        """
+        budget = token_budget - estimate_tokens(self.overview_text)
+        scores = self.scores(question)
+        ranked = sorted(
+            (i for i, score in enumerate(scores) if score > 0),
+            key=lambda i: scores[i], reverse=True
+        ) or list(range(len(self.sections)))
+
+        chosen = []
+        for i in ranked:
+            if len(chosen) >= top_k:
+                break
+            cost = estimate_tokens(self.texts[i])
+            if cost <= budget:
+                chosen.append(i)
+                budget -= cost
+
+        return {
+            "overview": self.overview,
+            "relevant_sections": [self.sections[i] for i in chosen],
+            "sections_included": len(chosen),
+            "sections_total": len(self.sections)
+        }
+
+class ReportIndexCache:
+    """LRU of ReportIndex by load_id; reports are immutable, so indexes are built once"""
+
+    def __init__(self, max_entries=16):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._indexes = OrderedDict()
+
+    def get(self, load_id, load_report):
+        """Index for load_id; load_report() supplies the report on a miss"""
+        with self._lock:
+            index = self._indexes.get(load_id)
+            if index is not None:
+                self._indexes.move_to_end(load_id)
+                return index
+
+        index = ReportIndex(load_report())
+        with self._lock:
+            self._indexes[load_id] = index
+            while len(self._indexes) > self.max_entries:
+                self._indexes.popitem(last=False)
+        return index
+
+REPORT_INDEXES = ReportIndexCache(max_entries=CHAT_INDEX_MAX_ENTRIES)
+
+CHAT_STOPWORDS = {
+    "a", "an", "the", "is", "are", "was", "were", "of", "in", "on", "for", "to",
+    "and", "or", "what", "which", "how", "do", "does", "me", "tell", "show",
+    "please", "there", "any", "this", "that", "it", "our", "we", "i", "can", "you"
+}
+
+# Fuzzy chat matches never cross a difference in these words, numbers or single letters
+CHAT_NEGATIONS = {
+    "no", "not", "none", "never", "without", "nor", "neither", "except", "excluding",
+    "cannot", "don", "doesn", "didn", "isn", "aren", "wasn", "weren", "hasn", "haven", "won"
+}
+
+def normalize_question(question):
+    return " ".join(re.findall(r"[a-z0-9_]+", question.lower()))
+
+class ChatAnswerCache:
+    """
+    Answers keyed by (load_id, normalized question), kept for `ttl`
+    seconds. With fuzzy_threshold below 1 (off by default), a question
+    whose content words overlap a cached one by at least that Jaccard
+    similarity also hits, unless the two differ in a negation, a number
+    or a single-letter token.
+    Entries for older loads are dropped when a newer load becomes latest.
+    """
+
+    def __init__(self, max_entries=1024, ttl=3600, fuzzy_threshold=1.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.fuzzy_threshold = fuzzy_threshold
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()   # (load_id, question) -> (words, answer, stored_at, guard)
+        self.hits = 0
+        self.fuzzy_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def content_words(question):
+        return frozenset(w for w in question.split() if w not in CHAT_STOPWORDS)
+
+    @staticmethod
+    def guard_words(question):
+        """Tokens that must match exactly for a fuzzy hit"""
+        return frozenset(
+            w for w in question.split()
+            if w in CHAT_NEGATIONS or len(w) == 1 or any(ch.isdigit() for ch in w)
+        )
+
+    def _fresh(self, entry):
+        return time.time() - entry[2] < self.ttl
+
+    def get(self, load_id, question):
+        question = normalize_question(question)
+        with self._lock:
+            entry = self._entries.get((load_id, question))
+            if entry and self._fresh(entry):
+                self._entries.move_to_end((load_id, question))
+                self.hits += 1
+                return entry[1]
+
+            if self.fuzzy_threshold < 1:
+                words, guard = self.content_words(question), self.guard_words(question)
+                best, best_score = None, self.fuzzy_threshold
+                for (cached_load, _), entry in self._entries.items():
+                    if cached_load != load_id or not self._fresh(entry) or not (words | entry[0]):
+                        continue
+                    if guard != entry[3]:
+                        continue
+                    score = len(words & entry[0]) / len(words | entry[0])
+                    if score >= best_score:
+                        best, best_score = entry, score
+                if best:
+                    self.fuzzy_hits += 1
+                    return best[1]
+
+            self.misses += 1
+            return None
+
+    def put(self, load_id, question, answer):
+        question = normalize_question(question)
+        with self._lock:
+            self._entries[(load_id, question)] = (
+                self.content_words(question), answer, time.time(), self.guard_words(question)
+            )
+            self._entries.move_to_end((load_id, question))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def retain(self, load_id):
+        """Drops answers for every load other than load_id"""
+        with self._lock:
+            for key in [k for k in self._entries if k[0] != load_id]:
+                del self._entries[key]
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.fuzzy_hits + self.misses
+            return {
+                "hits": self.hits,
+                "fuzzy_hits": self.fuzzy_hits,
+                "misses": self.misses,
+                "hit_rate": round((self.hits + self.fuzzy_hits) / lookups, 3) if lookups else None,
+                "entries": len(self._entries)
+            }
+
+CHAT_ANSWER_CACHE = ChatAnswerCache(
+    max_entries=int(os.getenv("CHAT_ANSWER_CACHE_MAX_ENTRIES", "1024")),
+    ttl=int(os.getenv("CHAT_ANSWER_CACHE_TTL", "3600")),
+    fuzzy_threshold=float(os.getenv("CHAT_ANSWER_FUZZY_THRESHOLD", "1"))
+)
+REPORT_CACHE.on_new_latest(CHAT_ANSWER_CACHE.retain)
+
 class ChatAgent(BaseAgent):
     def run(self, user_message, context):
         prompt = f"""
@@ -975,8 +4060,8 @@ Rules:
 - Be concise, business-friendly, and clear
 - Do NOT invent metrics or tables
 
-Latest Insights Context:
-{json.dumps(context)}
+Latest Insights Context (overview plus the report sections most relevant to the question):
+{json.dumps(context, default=json_default)}
 
 User Question:
 {user_message}
@@ -1001,23 +4086,56 @@ def chat():
                 "message": "Message is required"
             }), 400
 
-        session = get_snowflake_session()
+        use_cache = not request_flag("bypass_cache")
 
-        latest_report = get_latest_clean_report(session)
-        if not latest_report:
-            session.close()
+        def answered(load_id, cached):
             return jsonify({
-                "status": "error",
-                "message": "No insights available to answer questions"
-            }), 404
+                "status": "success",
+                "load_id": load_id,
+                "load_datetime": cached["load_datetime"],
+                "question": user_message,
+                "answer": cached["answer"],
+                "cached": True
+            })
 
-        chat_agent = ChatAgent(session)
-        response = chat_agent.run(
-            user_message=user_message,
-            context=latest_report["data"]
-        )
+        # Repeat questions on a known latest report skip Snowflake entirely
+        latest_id = REPORT_CACHE.latest()
+        cached = use_cache and latest_id and CHAT_ANSWER_CACHE.get(latest_id, user_message)
+        if cached:
+            return answered(latest_id, cached)
+
+        with pooled_env_session() as session:
+            latest_report = get_latest_clean_report(session)
+            if not latest_report:
+                return jsonify({
+                    "status": "error",
+                    "message": "No insights available to answer questions"
+                }), 404
+
+            if use_cache and latest_report["load_id"] != latest_id:
+                cached = CHAT_ANSWER_CACHE.get(latest_report["load_id"], user_message)
+                if cached:
+                    return answered(latest_report["load_id"], cached)
+
+            # The report is only parsed when its index is not built yet
+            index = REPORT_INDEXES.get(
+                latest_report["load_id"], lambda: json.loads(latest_report["payload"])
+            )
+            chat_agent = ChatAgent(session, use_cache=use_cache)
+            response = chat_agent.run(
+                user_message=user_message,
+                context=index.context(
+                    user_message,
+                    top_k=CHAT_CONTEXT_TOP_K,
+                    token_budget=CHAT_CONTEXT_TOKEN_BUDGET
+                )
+            )
 
-        session.close()
+        if response.get("answer"):
+            CHAT_ANSWER_CACHE.put(latest_report["load_id"], user_message, {
+                "load_datetime": latest_report["load_datetime"],
+                "answer": response["answer"]
+            })
 
         return jsonify({
             "status": "success",
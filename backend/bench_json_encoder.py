@@ -0,0 +1,89 @@
+"""
+Micro-benchmark for report serialization.
+
+Compares the previous path (sanitize_for_json over the whole report,
+then json.dumps for the PARSE_JSON insert and again for the HTTP
+response) with a single encode_json pass on a large synthetic report.
+
+    python bench_json_encoder.py [tables] [rows_per_chart] [repeat]
+"""
+import sys
+import json
+import time
+import random
+from datetime import datetime, date, timedelta
+from decimal import Decimal
+
+import app
+
+
+def synthetic_report(tables=200, rows=500):
+    random.seed(7)
+    start = date(2024, 1, 1)
+    report = {
+        "meta": {"load_id": "bench", "generated_at": datetime.now(), "tables_analyzed": tables},
+        "tables": [],
+        "kpis": [],
+        "charts": [],
+        "data_quality": {"signals": {}},
+    }
+    for t in range(tables):
+        name = f"TABLE_{t}"
+        report["tables"].append({
+            "table_name": name,
+            "row_count": random.randint(0, 10**7),
+            "last_altered": datetime(2024, 6, 1, 12, 30) + timedelta(hours=t),
+            "columns": [{"column": f"COL_{c}", "type": "NUMBER"} for c in range(20)],
+        })
+        report["kpis"].append({"name": f"KPI {t}", "value": Decimal(f"{random.random() * 10**6:.2f}")})
+        report["charts"].append({
+            "title": f"Chart {t}",
+            "sample_data": [
+                {"DAY": start + timedelta(days=r), "VALUE": Decimal(f"{random.random() * 1000:.4f}"),
+                 "RATIO": float("nan") if r % 97 == 0 else random.random()}
+                for r in range(rows)
+            ],
+        })
+        report["data_quality"]["signals"][name] = {"null_rate": random.random(), "duplicates": random.randint(0, 50)}
+    return report
+
+
+def legacy(report):
+    clean = app.sanitize_for_json(report)
+    stored = json.dumps(clean)
+    response = json.dumps({"status": "success", "data": clean})
+    return stored, response
+
+
+def single_pass(report):
+    payload = app.encode_json(report)
+    stored = payload.decode("utf-8")
+    response = b'{"status": "success", "data": ' + payload + b"}"
+    return stored, response
+
+
+def timed(fn, report, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn(report)
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+if __name__ == "__main__":
+    args = [int(a) for a in sys.argv[1:4]]
+    tables, rows, repeat = args + [200, 500, 5][len(args):]
+    report = synthetic_report(tables, rows)
+    size = len(app.encode_json(report))
+    print(f"Synthetic report: {tables} tables, {rows} chart rows each, {size / 1e6:.1f} MB")
+
+    before = timed(legacy, report, repeat)
+    after = timed(single_pass, report, repeat)
+    print(f"sanitize_for_json + json.dumps x2: {before * 1000:8.1f} ms")
+    print(f"encode_json once ({'orjson' if app.orjson else 'json'}):".ljust(34) + f"{after * 1000:8.1f} ms")
+    print(f"Speedup: {before / after:.1f}x")
+
+    app.orjson = None
+    fallback = timed(single_pass, report, repeat)
+    print(f"encode_json once (json fallback): {fallback * 1000:8.1f} ms")
@@ -0,0 +1,48 @@
+"""Pure helpers of the generated SQL guard: python -m pytest backend/tests"""
+import os
+import sys
+
+import pytest
+
+pytest.importorskip("flask")
+pytest.importorskip("snowflake.snowpark")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app  # noqa: E402
+
+
+@pytest.mark.parametrize("sql, expected", [
+    ("SELECT A FROM T", "SELECT A FROM T\nLIMIT 20"),
+    ("SELECT A FROM T;", "SELECT A FROM T\nLIMIT 20"),
+    ("SELECT A FROM T LIMIT 5", "SELECT A FROM T LIMIT 5"),
+    ("SELECT A FROM T LIMIT 50", "SELECT A FROM T LIMIT 20"),
+    ("SELECT A FROM T WHERE B = '-- not a comment'", "SELECT A FROM T WHERE B = '-- not a comment'\nLIMIT 20"),
+    (
+        "SELECT DAY, SUM(V) AS VALUE FROM T GROUP BY DAY -- daily totals",
+        "SELECT DAY, SUM(V) AS VALUE FROM T GROUP BY DAY\nLIMIT 20"
+    ),
+    ("select a from t limit 50 -- c", "select a from t limit 20"),
+    ("select a from t limit 50 /* c */ ;", "select a from t limit 20"),
+    ("SELECT TOP 5 A FROM T; -- c\n-- d", "SELECT * FROM (\nSELECT TOP 5 A FROM T\n) LIMIT 20"),
+])
+def test_cap_rows(sql, expected):
+    assert app.cap_rows(sql, 20) == expected
+
+
+def test_cap_rows_keeps_inner_line_comments_inside_the_subquery():
+    capped = app.cap_rows("SELECT A -- first\nFROM T FETCH FIRST 50 ROWS ONLY", 20)
+    assert capped.endswith("\n) LIMIT 20")
+
+
+@pytest.mark.parametrize("sql", [
+    "DELETE FROM T",
+    "SELECT 1; DROP TABLE T",
+    "WITH X AS (SELECT 1) INSERT INTO T SELECT * FROM X",
+])
+def test_validate_read_only_rejects_writes(sql):
+    with pytest.raises(ValueError):
+        app.validate_read_only(sql)
+
+
+def test_validate_read_only_ignores_keywords_in_literals():
+    app.validate_read_only("SELECT 'DROP TABLE T' AS A FROM T -- delete")